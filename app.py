@@ -30,36 +30,78 @@
 # 6. INIT_DB / MIGRATE_JSON
 #    Plus besoin de create_all() : les tables existent déjà dans Supabase.
 #    migrate_json_to_db() reste présent pour copier d'éventuels JSON locaux.
+#
+# 7. MOTEUR DE STOCKAGE
+#    KASSUA_STORAGE=supabase (défaut) ou KASSUA_STORAGE=sqlite.
+#    En mode sqlite, la base locale est KASSUA_DB_PATH (défaut : kassua.db),
+#    créée automatiquement (mode WAL), sans aucun appel réseau. Les connexions
+#    viennent d'un pool partagé entre threads, borné par KASSUA_DB_POOL (défaut 8).
+#
+# 8. CHARGEMENT CONCURRENT
+#    Les lectures de début de session partent en parallèle dans un pool borné
+#    (KASSUA_LOAD_WORKERS, défaut 4) avec un délai maximal KASSUA_LOAD_TIMEOUT
+#    (secondes, défaut 10) ; une source en retard passe la session en mode dégradé.
+#
+# 9. ÉCRITURES DIFFÉRÉES
+#    Paniers et mises à jour / suppressions de produits passent par une file vidée
+#    en arrière-plan, journalisée dans KASSUA_WRITE_JOURNAL (défaut : kassua_writes.jsonl)
+#    et rejouée au démarrage. Un journal par processus : le premier libre parmi
+#    <journal>, <journal>.1, <journal>.2… (verrou <journal>.lock) ; les journaux des
+#    processus arrêtés sont repris au démarrage. Lots : KASSUA_WRITE_BATCH (50) /
+#    KASSUA_WRITE_DELAY (0.5 s).
+#
+# 10. PROPAGATION ENTRE SESSIONS
+#    Des triggers sur products / purchases journalisent chaque écriture dans data_changes
+#    et avancent data_versions. Au rerun, data_versions est sondé (au plus toutes les
+#    KASSUA_POLL_INTERVAL secondes, défaut 2) et seules les lignes changées sont relues.
+#    Journal purgé après KASSUA_CHANGE_RETENTION heures (défaut 24).
 # ============================================================
 
 import streamlit as st
 import json
 import os
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import random
 import plotly.express as px
 import plotly.graph_objects as go
+import glob
 import hashlib
+import itertools
+import queue
+import heapq
+import math
+import re
 import secrets
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from scipy import sparse
 
 # ── Supabase client ──────────────────────────────────────────
-from supabase import create_client, Client
-
 SUPABASE_URL = os.getenv("SUPABASE_URL", "https://ufwylvnlmasvbqcchmqj.supabase.co")   # à renseigner dans .env ou secrets Streamlit
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "sb_publishable_f_9Pwhw_bQWsYA0-ciYWLA_ufZUQ5h2")   # clé anon (ou service_role si RLS désactivé)
 
 @st.cache_resource          # crée le client une seule fois par session serveur
-def get_supabase() -> Client:
+def get_supabase():
+    # import local : le moteur SQLite (KASSUA_STORAGE=sqlite) n'a pas besoin de supabase-py
+    from supabase import ClientOptions, create_client
     if not SUPABASE_URL or not SUPABASE_KEY:
         st.error(
             "⚠️ Variables SUPABASE_URL et SUPABASE_KEY manquantes. "
             "Ajoutez-les dans vos secrets Streamlit ou un fichier .env."
         )
         st.stop()
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
-
-supabase: Client = get_supabase()
+    # délai HTTP borné : une requête bloquée ne retient pas indéfiniment un thread de chargement
+    return create_client(SUPABASE_URL, SUPABASE_KEY,
+                         options=ClientOptions(postgrest_client_timeout=LOAD_TIMEOUT))
 # ─────────────────────────────────────────────────────────────
 
 # Configuration de la page
@@ -128,8 +170,8 @@ PRODUCT_EMOJIS = {
 for k, v in [
     ('logged_in', False), ('user_type', None),
     ('current_user', None), ('products', []),
-    ('users', []), ('purchases', []),
-    ('cart', []), ('user_carts', {})
+    ('purchases', []),
+    ('cart', {}), ('user_carts', {})
 ]:
     if k not in st.session_state:
         st.session_state[k] = v
@@ -152,7 +194,7 @@ except Exception:
 
 
 # ═══════════════════════════════════════════════════════════════
-#  COUCHE BASE DE DONNÉES — Supabase
+#  COUCHE BASE DE DONNÉES — Supabase ou SQLite
 # ═══════════════════════════════════════════════════════════════
 
 def _rows(response) -> list:
@@ -163,160 +205,1736 @@ def _rows(response) -> list:
         return []
 
 
+# ── STOCKAGE ──────────────────────────────────────────────────
+# Le moteur est choisi par KASSUA_STORAGE : "supabase" (défaut) ou "sqlite".
+# Les méthodes des moteurs lèvent en cas d'erreur ; les fonctions load_*/insert_*/...
+# plus bas les attrapent et affichent un avertissement.
+STORAGE_BACKEND = os.getenv("KASSUA_STORAGE", "supabase").lower()
+SQLITE_PATH     = os.getenv("KASSUA_DB_PATH", "kassua.db")
+SQLITE_POOL     = int(os.getenv("KASSUA_DB_POOL", "8"))
+LOAD_WORKERS    = int(os.getenv("KASSUA_LOAD_WORKERS", "4"))
+LOAD_TIMEOUT    = float(os.getenv("KASSUA_LOAD_TIMEOUT", "10"))   # secondes
+
+TABLE_COLUMNS = {
+    "users":           ("id", "username", "email", "password", "created_at", "is_admin"),
+    "password_resets": ("token", "username", "expires_at"),
+    "products":        ("id", "produit", "ville", "prix", "date", "categorie", "vendeur", "contact"),
+    "purchases":       ("id", "produit", "prix", "vendeur", "contact", "categorie", "ville", "date_achat",
+                        "acheteur", "order_id"),
+    "orders":          ("id", "idempotency_key", "acheteur", "created_at", "lines"),
+    "carts":           ("id", "username", "line_key", "product_id", "produit", "prix", "vendeur",
+                        "contact", "categorie", "ville", "date", "quantity"),
+    "app_meta":        ("key", "value"),
+    "sales_daily":     ("jour", "produit", "categorie", "ville", "vendeur", "units", "revenue"),
+    "data_versions":   ("tbl", "version"),
+    "data_changes":    ("seq", "tbl", "row_id", "deleted", "changed_at"),
+}
+
+# Tables dont les écritures sont journalisées (data_changes) et propagées aux autres sessions
+TRACKED_TABLES = ("products", "purchases")
+
+
+class Storage(ABC):
+    """Interface commune des moteurs de stockage (users, products, purchases, carts).
+
+    Classe abstraite : un moteur incomplet échoue dès sa construction, pas au premier appel manquant.
+    """
+
+    @abstractmethod
+    def fetch_table(self, table: str) -> list: ...
+    @abstractmethod
+    def is_empty(self, table: str) -> bool: ...
+    # users
+    @abstractmethod
+    def insert_users(self, users: list) -> list: ...
+    @abstractmethod
+    def find_user(self, login: str): ...
+    @abstractmethod
+    def upsert_user(self, user: dict, ignore_duplicates: bool = False): ...
+    @abstractmethod
+    def update_user(self, username: str, fields: dict): ...
+    # reset tokens
+    @abstractmethod
+    def insert_reset_token(self, row: dict, purge_before: str): ...
+    @abstractmethod
+    def find_reset_token(self, token: str, valid_after: str): ...
+    @abstractmethod
+    def delete_reset_token(self, token: str): ...
+    # products
+    @abstractmethod
+    def insert_products(self, products: list) -> list: ...
+    @abstractmethod
+    def update_product(self, product_id, fields: dict): ...
+    @abstractmethod
+    def delete_products(self, product_ids: list): ...
+    @abstractmethod
+    def query_products(self, categorie=None, after_id=None, limit: int = 12) -> list: ...
+    @abstractmethod
+    def product_stats(self, categorie=None) -> dict: ...
+    # purchases
+    @abstractmethod
+    def insert_purchases(self, purchases: list) -> list: ...
+    @abstractmethod
+    def replace_purchases(self, purchases: list): ...
+    @abstractmethod
+    def checkout(self, username, purchases: list, idempotency_key: str) -> dict: ...
+    # sales_daily (agrégats journaliers, tenus à jour par trigger sur purchases)
+    @abstractmethod
+    def sales_rollup(self, start: str, end: str) -> list: ...
+    @abstractmethod
+    def sales_totals(self, start: str = None, end: str = None) -> dict: ...
+    @abstractmethod
+    def top_products_by_category(self, limit: int = 5) -> list: ...
+    @abstractmethod
+    def rebuild_sales_rollup(self): ...
+    # carts
+    @abstractmethod
+    def load_cart(self, username: str) -> list: ...
+    @abstractmethod
+    def upsert_cart_lines(self, rows: list): ...
+    @abstractmethod
+    def delete_cart_line(self, username: str, line_key: str): ...
+    @abstractmethod
+    def delete_cart(self, username: str): ...
+    # app_meta
+    @abstractmethod
+    def get_meta(self, key: str): ...
+    @abstractmethod
+    def set_meta(self, key: str, value: str): ...
+    # flux de changements : data_versions (dernier seq par table) + data_changes (None = journal purgé)
+    @abstractmethod
+    def data_versions(self) -> dict: ...
+    @abstractmethod
+    def changes_since(self, table: str, seq: int): ...
+    @abstractmethod
+    def fetch_rows(self, table: str, ids: list) -> list: ...
+    @abstractmethod
+    def prune_changes(self, max_age_hours: float): ...
+    # grilles d'administration : (lignes de la page, nombre total de lignes filtrées)
+    @abstractmethod
+    def query_table(self, table: str, columns: tuple, sort: str, descending: bool = False, filters: dict = None,
+                    search: str = None, search_columns: tuple = (), offset: int = 0, limit: int = 25) -> tuple: ...
+
+
+def _check_columns(table: str, names):
+    """Les noms de colonnes des grilles finissent dans la requête : liste blanche obligatoire."""
+    unknown = set(names) - set(TABLE_COLUMNS.get(table, ()))
+    if unknown:
+        raise ValueError(f"Colonnes inconnues pour {table}: {sorted(unknown)}")
+
+
+class SupabaseStorage(Storage):
+    """Moteur historique : API REST Supabase (PostgREST)."""
+
+    def __init__(self, client):
+        self.db = client
+
+    def fetch_table(self, table):
+        return _rows(self.db.table(table).select("*").execute())
+
+    def is_empty(self, table):
+        return not _rows(self.db.table(table).select("id").limit(1).execute())
+
+    def _insert_chunked(self, table, rows):
+        # Supabase accepte jusqu'à 1000 lignes par insert ; on chunke par 500
+        saved = []
+        for i in range(0, len(rows), 500):
+            saved.extend(_rows(self.db.table(table).insert(rows[i:i+500]).execute()))
+        return saved
+
+    def insert_users(self, users):
+        return self._insert_chunked("users", users)
+
+    def find_user(self, login):
+        # deux égalités sur colonnes uniques (index) plutôt qu'un or=() à échapper
+        for column in ("username", "email"):
+            rows = _rows(self.db.table("users").select("*").eq(column, login).limit(1).execute())
+            if rows:
+                return rows[0]
+        return None
+
+    def upsert_user(self, user, ignore_duplicates=False):
+        rows = _rows(self.db.table("users")
+                     .upsert(user, on_conflict="username", ignore_duplicates=ignore_duplicates)
+                     .execute())
+        return rows[0] if rows else None
+
+    def update_user(self, username, fields):
+        rows = _rows(self.db.table("users").update(fields).eq("username", username).execute())
+        return rows[0] if rows else None
+
+    def insert_reset_token(self, row, purge_before):
+        self.db.table("password_resets").delete().lt("expires_at", purge_before).execute()
+        self.db.table("password_resets").insert(row).execute()
+
+    def find_reset_token(self, token, valid_after):
+        rows = _rows(self.db.table("password_resets").select("*")
+                     .eq("token", token).gte("expires_at", valid_after)
+                     .limit(1).execute())
+        return rows[0] if rows else None
+
+    def delete_reset_token(self, token):
+        self.db.table("password_resets").delete().eq("token", token).execute()
+
+    def insert_products(self, products):
+        return self._insert_chunked("products", products)
+
+    def update_product(self, product_id, fields):
+        rows = _rows(self.db.table("products").update(fields).eq("id", product_id).execute())
+        return rows[0] if rows else None
+
+    def delete_products(self, product_ids):
+        self.db.table("products").delete().in_("id", list(product_ids)).execute()
+
+    def query_products(self, categorie=None, after_id=None, limit=12):
+        q = self.db.table("products").select("*")
+        if categorie:
+            q = q.eq("categorie", categorie)
+        if after_id is not None:
+            q = q.gt("id", after_id)
+        return _rows(q.order("id").limit(limit).execute())
+
+    def product_stats(self, categorie=None):
+        rows = _rows(self.db.rpc("product_stats", {"p_categorie": categorie}).execute())
+        return rows[0] if rows else {"count": 0, "avg_price": None, "cities": 0}
+
+    def insert_purchases(self, purchases):
+        return self._insert_chunked("purchases", purchases)
+
+    def replace_purchases(self, purchases):
+        self.db.table("purchases").delete().neq("id", 0).execute()
+        if purchases:
+            self._insert_chunked("purchases", purchases)
+
+    def checkout(self, username, purchases, idempotency_key):
+        return self.db.rpc("checkout", {"p_username": username, "p_purchases": purchases,
+                                        "p_key": idempotency_key}).execute().data
+
+    def sales_rollup(self, start, end):
+        # PostgREST plafonne les réponses (1000 lignes) : on pagine sur la clé primaire
+        rows, page = [], 1000
+        while True:
+            chunk = _rows(self.db.table("sales_daily").select("*")
+                          .gte("jour", start).lte("jour", end)
+                          .order("jour").order("produit").order("categorie").order("ville").order("vendeur")
+                          .range(len(rows), len(rows) + page - 1).execute())
+            rows.extend(chunk)
+            if len(chunk) < page:
+                return rows
+
+    def sales_totals(self, start=None, end=None):
+        rows = _rows(self.db.rpc("sales_totals", {"p_start": start, "p_end": end}).execute())
+        return rows[0] if rows else {"units": 0, "revenue": 0}
+
+    def top_products_by_category(self, limit=5):
+        return _rows(self.db.rpc("top_products_by_category", {"p_limit": limit}).execute())
+
+    def rebuild_sales_rollup(self):
+        self.db.rpc("rebuild_sales_daily", {}).execute()
+
+    def load_cart(self, username):
+        return _rows(self.db.table("carts").select("*").eq("username", username).order("id").execute())
+
+    def upsert_cart_lines(self, rows):
+        self.db.table("carts").upsert(rows, on_conflict="username,line_key").execute()
+
+    def delete_cart_line(self, username, line_key):
+        self.db.table("carts").delete().eq("username", username).eq("line_key", line_key).execute()
+
+    def delete_cart(self, username):
+        self.db.table("carts").delete().eq("username", username).execute()
+
+    def get_meta(self, key):
+        rows = _rows(self.db.table("app_meta").select("value").eq("key", key).limit(1).execute())
+        return rows[0].get("value") if rows else None
+
+    def set_meta(self, key, value):
+        self.db.table("app_meta").upsert({"key": key, "value": value}, on_conflict="key").execute()
+
+    def data_versions(self):
+        return {r["tbl"]: r["version"] for r in _rows(self.db.table("data_versions").select("tbl,version").execute())}
+
+    def changes_since(self, table, seq):
+        floor = self.get_meta("changes_floor")
+        if floor and seq < int(floor):
+            return None
+        rows, page = [], 1000
+        while True:
+            chunk = _rows(self.db.table("data_changes").select("seq,row_id,deleted")
+                          .eq("tbl", table).gt("seq", seq).order("seq")
+                          .range(len(rows), len(rows) + page - 1).execute())
+            rows.extend(chunk)
+            if len(chunk) < page:
+                return rows
+
+    def fetch_rows(self, table, ids):
+        rows = []
+        for i in range(0, len(ids), 500):
+            rows.extend(_rows(self.db.table(table).select("*").in_("id", ids[i:i+500]).execute()))
+        return rows
+
+    def prune_changes(self, max_age_hours):
+        self.db.rpc("prune_data_changes", {"p_hours": max_age_hours}).execute()
+
+    def query_table(self, table, columns, sort, descending=False, filters=None,
+                    search=None, search_columns=(), offset=0, limit=25):
+        _check_columns(table, [*columns, sort, *(filters or {}), *search_columns])
+        q = self.db.table(table).select(",".join(columns), count="exact")
+        for col, value in (filters or {}).items():
+            q = q.eq(col, value)
+        # la syntaxe or=(…) de PostgREST réserve , ( ) " : on les retire du terme cherché
+        term = re.sub(r'[,()"*%\\]', ' ', search or '').strip()
+        if term and search_columns:
+            q = q.or_(",".join(f"{col}.ilike.*{term}*" for col in search_columns))
+        q = q.order(sort, desc=descending)
+        if sort != "id":
+            q = q.order("id")
+        response = q.range(offset, offset + limit - 1).execute()
+        return _rows(response), response.count or 0
+
+
+SQLITE_SCHEMA = """
+create table if not exists users (
+  id         integer primary key autoincrement,
+  username   text unique not null,
+  email      text unique not null,
+  password   text not null,
+  created_at text,
+  is_admin   integer default 0
+);
+create table if not exists password_resets (
+  token      text primary key,
+  username   text not null,
+  expires_at text not null
+);
+create index if not exists password_resets_expires_idx on password_resets (expires_at);
+create table if not exists products (
+  id        integer primary key autoincrement,
+  produit   text not null,
+  ville     text,
+  prix      text,
+  date      text,
+  categorie text,
+  vendeur   text,
+  contact   text
+);
+create index if not exists products_categorie_idx on products (categorie);
+create table if not exists purchases (
+  id         integer primary key autoincrement,
+  produit    text not null,
+  prix       text,
+  vendeur    text,
+  contact    text,
+  categorie  text,
+  ville      text,
+  date_achat text,
+  acheteur   text,
+  order_id   integer references orders (id)
+);
+create index if not exists purchases_acheteur_idx on purchases (acheteur);
+create index if not exists purchases_date_idx on purchases (date_achat);
+create table if not exists orders (
+  id              integer primary key autoincrement,
+  idempotency_key text unique not null,
+  acheteur        text,
+  created_at      text,
+  lines           integer
+);
+create table if not exists sales_daily (
+  jour      text not null,
+  produit   text not null default '',
+  categorie text not null default '',
+  ville     text not null default '',
+  vendeur   text not null default '',
+  units     integer not null default 0,
+  revenue   real not null default 0,
+  primary key (jour, produit, categorie, ville, vendeur)
+);
+create table if not exists carts (
+  id         integer primary key autoincrement,
+  username   text not null,
+  line_key   text,
+  product_id integer,
+  produit    text not null,
+  prix       text,
+  vendeur    text,
+  contact    text,
+  categorie  text,
+  ville      text,
+  date       text,
+  quantity   integer default 1
+);
+create table if not exists app_meta (
+  key   text primary key,
+  value text
+);
+create table if not exists data_versions (
+  tbl     text primary key,
+  version integer not null default 0
+);
+create table if not exists data_changes (
+  seq        integer primary key autoincrement,
+  tbl        text not null,
+  row_id     integer not null,
+  deleted    integer not null default 0,
+  changed_at text not null default (datetime('now'))
+);
+create index if not exists data_changes_tbl_idx on data_changes (tbl, seq);
+"""
+
+# Une ligne de data_changes par écriture (deleted = 1 : pierre tombale) ; data_versions.version = dernier seq
+SQLITE_CHANGE_TRIGGER = """
+create trigger if not exists {table}_changes_{op} after {op} on {table} begin
+  insert into data_changes (tbl, row_id, deleted) values ('{table}', {ref}.id, {deleted});
+  insert into data_versions (tbl, version) values ('{table}', (select max(seq) from data_changes))
+  on conflict (tbl) do update set version = excluded.version;
+end
+"""
+
+# Une ligne d'achat = une unité ; jour = AAAA-MM-JJ de date_achat, dimensions absentes -> ''
+SQLITE_SALES_TRIGGER = """
+create trigger if not exists purchases_sales_daily after insert on purchases begin
+  insert into sales_daily (jour, produit, categorie, ville, vendeur, units, revenue)
+  values (coalesce(substr(new.date_achat, 1, 10), ''), coalesce(new.produit, ''), coalesce(new.categorie, ''),
+          coalesce(new.ville, ''), coalesce(new.vendeur, ''), 1, coalesce(cast(nullif(new.prix, '') as real), 0))
+  on conflict (jour, produit, categorie, ville, vendeur) do update
+    set units = units + excluded.units, revenue = revenue + excluded.revenue;
+end
+"""
+
+SQLITE_SALES_REBUILD = """
+insert into sales_daily (jour, produit, categorie, ville, vendeur, units, revenue)
+select coalesce(substr(date_achat, 1, 10), ''), coalesce(produit, ''), coalesce(categorie, ''),
+       coalesce(ville, ''), coalesce(vendeur, ''), count(*), sum(coalesce(cast(nullif(prix, '') as real), 0))
+from purchases group by 1, 2, 3, 4, 5
+"""
+
+
+class SQLiteStorage(Storage):
+    """Moteur local : fichier SQLite en mode WAL, pool borné de connexions partagé entre threads.
+
+    Streamlit lance un nouveau thread à presque chaque rerun : une connexion par thread serait
+    rouverte à chaque interaction. Le pool garde les connexions (et leurs pragmas) ouvertes, et
+    les requêtes, chaînes constantes paramétrées, restent dans le cache de requêtes préparées
+    de chaque connexion (cached_statements).
+    """
+
+    def __init__(self, path: str, pool_size: int = SQLITE_POOL):
+        self.path      = path
+        self._pool     = queue.LifoQueue()   # LIFO : la connexion la plus chaude ressert d'abord
+        self._slots    = threading.BoundedSemaphore(max(1, pool_size))
+        with self._conn() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+            self._upgrade_carts(conn)
+            self._upgrade_purchases(conn)
+            self._track_changes(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, cached_statements=256, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("pragma journal_mode=wal")
+        conn.execute("pragma synchronous=normal")
+        return conn
+
+    @contextmanager
+    def _conn(self):
+        """Emprunte une connexion (utilisée par un seul thread à la fois) puis la rend au pool."""
+        if not self._slots.acquire(timeout=10):
+            raise sqlite3.OperationalError("pool de connexions SQLite saturé")
+        try:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._pool.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def _tx(self):
+        """Connexion empruntée + transaction (commit, ou rollback si exception)."""
+        with self._conn() as conn, conn:
+            yield conn
+
+    def _upgrade_carts(self, conn):
+        """Ajoute line_key/product_id aux bases créées par scripts/migrate_sql_to_sqlite.py."""
+        columns = {r["name"] for r in conn.execute("pragma table_info(carts)")}
+        with conn:
+            if "product_id" not in columns:
+                conn.execute("alter table carts add column product_id integer")
+            if "line_key" not in columns:
+                conn.execute("alter table carts add column line_key text")
+            conn.execute("update carts set line_key = coalesce(product_id, produit) || '|' || coalesce(vendeur, '—')"
+                         " where line_key is null")
+            conn.execute("delete from carts where id not in"
+                         " (select max(id) from carts group by username, line_key)")
+            conn.execute("create unique index if not exists carts_user_line_idx on carts (username, line_key)")
+
+    def _upgrade_purchases(self, conn):
+        """Colonnes ville / order_id (bases antérieures) et trigger d'alimentation de sales_daily."""
+        columns = {r["name"] for r in conn.execute("pragma table_info(purchases)")}
+        with conn:
+            if "ville" not in columns:
+                conn.execute("alter table purchases add column ville text")
+            if "order_id" not in columns:
+                conn.execute("alter table purchases add column order_id integer references orders (id)")
+            conn.execute("create index if not exists purchases_order_idx on purchases (order_id)")
+            conn.execute(SQLITE_SALES_TRIGGER)
+
+    def _track_changes(self, conn):
+        """Triggers du flux de changements sur les tables propagées entre sessions."""
+        with conn:
+            for table in TRACKED_TABLES:
+                for op, ref, deleted in (("insert", "new", 0), ("update", "new", 0), ("delete", "old", 1)):
+                    conn.execute(SQLITE_CHANGE_TRIGGER.format(table=table, op=op, ref=ref, deleted=deleted))
+
+    def _query(self, sql, params=()) -> list:
+        with self._conn() as conn:
+            return [dict(r) for r in conn.execute(sql, params)]
+
+    def _one(self, sql, params=()):
+        with self._conn() as conn:
+            row = conn.execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    @staticmethod
+    def _clean(table, row: dict) -> dict:
+        return {k: v for k, v in row.items() if k in TABLE_COLUMNS[table]}
+
+    def _insert(self, conn, table, row: dict):
+        row  = self._clean(table, row)
+        cols = ", ".join(row)
+        sql  = f"insert into {table} ({cols}) values ({', '.join('?' * len(row))}) returning *"
+        return dict(conn.execute(sql, tuple(row.values())).fetchone())
+
+    def _insert_many(self, table, rows: list) -> list:
+        with self._tx() as conn:
+            return [self._insert(conn, table, r) for r in rows]
+
+    def _update(self, table, key_col, key, fields: dict):
+        fields = self._clean(table, fields)
+        if not fields:
+            return None
+        sets = ", ".join(f"{c} = ?" for c in fields)
+        with self._tx() as conn:
+            row = conn.execute(f"update {table} set {sets} where {key_col} = ? returning *",
+                               (*fields.values(), key)).fetchone()
+        return dict(row) if row else None
+
+    def fetch_table(self, table):
+        return self._query(f"select * from {table} order by id")
+
+    def is_empty(self, table):
+        return self._one(f"select 1 from {table} limit 1") is None
+
+    def insert_users(self, users):
+        return self._insert_many("users", users)
+
+    def find_user(self, login):
+        rows = self._query("select * from users where username = :login or email = :login limit 1",
+                           {"login": login})
+        return rows[0] if rows else None
+
+    def upsert_user(self, user, ignore_duplicates=False):
+        with self._tx() as conn:
+            if ignore_duplicates:
+                if conn.execute("select 1 from users where username = ?", (user.get("username"),)).fetchone():
+                    return None
+                return self._insert(conn, "users", user)
+            fields = self._clean("users", user)
+            sets   = ", ".join(f"{c} = excluded.{c}" for c in fields if c not in ("id", "username"))
+            sql    = (f"insert into users ({', '.join(fields)}) values ({', '.join('?' * len(fields))})"
+                      f" on conflict(username) do update set {sets or 'username = excluded.username'} returning *")
+            return dict(conn.execute(sql, tuple(fields.values())).fetchone())
+
+    def update_user(self, username, fields):
+        return self._update("users", "username", username, fields)
+
+    def insert_reset_token(self, row, purge_before):
+        with self._tx() as conn:
+            conn.execute("delete from password_resets where expires_at < ?", (purge_before,))
+            self._insert(conn, "password_resets", row)
+
+    def find_reset_token(self, token, valid_after):
+        rows = self._query("select * from password_resets where token = ? and expires_at >= ?",
+                           (token, valid_after))
+        return rows[0] if rows else None
+
+    def delete_reset_token(self, token):
+        with self._tx() as conn:
+            conn.execute("delete from password_resets where token = ?", (token,))
+
+    def insert_products(self, products):
+        return self._insert_many("products", products)
+
+    def update_product(self, product_id, fields):
+        return self._update("products", "id", product_id, fields)
+
+    def delete_products(self, product_ids):
+        with self._tx() as conn:
+            conn.executemany("delete from products where id = ?", [(i,) for i in product_ids])
+
+    def query_products(self, categorie=None, after_id=None, limit=12):
+        return self._query("select * from products"
+                           " where (:cat is null or categorie = :cat) and id > coalesce(:after, -1)"
+                           " order by id limit :limit",
+                           {"cat": categorie, "after": after_id, "limit": limit})
+
+    def product_stats(self, categorie=None):
+        return self._one("select count(*) as count, avg(cast(nullif(prix, '') as real)) as avg_price,"
+                         " count(distinct ville) as cities from products where (:cat is null or categorie = :cat)",
+                         {"cat": categorie})
+
+    def insert_purchases(self, purchases):
+        return self._insert_many("purchases", purchases)
+
+    def replace_purchases(self, purchases):
+        with self._tx() as conn:
+            conn.execute("delete from purchases")
+            for p in purchases:
+                self._insert(conn, "purchases", p)
+
+    def checkout(self, username, purchases, idempotency_key):
+        with self._tx() as conn:
+            row = conn.execute("insert into orders (idempotency_key, acheteur, created_at, lines) values (?, ?, ?, ?)"
+                               " on conflict (idempotency_key) do nothing returning id",
+                               (idempotency_key, username, datetime.now().isoformat(), len(purchases))).fetchone()
+            if row is None:
+                order_id = conn.execute("select id from orders where idempotency_key = ?",
+                                        (idempotency_key,)).fetchone()["id"]
+                saved = [dict(r) for r in conn.execute("select * from purchases where order_id = ? order by id",
+                                                       (order_id,))]
+                if username:
+                    conn.execute("delete from carts where username = ?", (username,))
+                return {"order_id": order_id, "purchases": saved, "replayed": True}
+            order_id = row["id"]
+            saved = [self._insert(conn, "purchases", {**p, "order_id": order_id}) for p in purchases]
+            if username:
+                conn.execute("delete from carts where username = ?", (username,))
+        return {"order_id": order_id, "purchases": saved, "replayed": False}
+
+    def sales_rollup(self, start, end):
+        return self._query("select * from sales_daily where jour between ? and ? order by jour", (start, end))
+
+    def sales_totals(self, start=None, end=None):
+        return self._one("select coalesce(sum(units), 0) as units, coalesce(sum(revenue), 0) as revenue"
+                         " from sales_daily where (:start is null or jour >= :start) and (:end is null or jour <= :end)",
+                         {"start": start, "end": end})
+
+    def top_products_by_category(self, limit=5):
+        return self._query(
+            "select categorie, produit, achats from ("
+            "  select categorie, produit, sum(units) as achats,"
+            "         row_number() over (partition by categorie order by sum(units) desc, produit) as rang"
+            "  from sales_daily group by categorie, produit)"
+            " where rang <= ? order by categorie, rang", (limit,))
+
+    def rebuild_sales_rollup(self):
+        with self._tx() as conn:
+            conn.execute("delete from sales_daily")
+            conn.execute(SQLITE_SALES_REBUILD)
+
+    def load_cart(self, username):
+        return self._query("select * from carts where username = ? order by id", (username,))
+
+    def upsert_cart_lines(self, rows):
+        cols = [c for c in TABLE_COLUMNS["carts"] if c != "id"]
+        sets = ", ".join(f"{c} = excluded.{c}" for c in cols if c not in ("username", "line_key"))
+        sql  = (f"insert into carts ({', '.join(cols)}) values ({', '.join('?' * len(cols))})"
+                f" on conflict(username, line_key) do update set {sets}")
+        with self._tx() as conn:
+            conn.executemany(sql, [tuple(r.get(c) for c in cols) for r in rows])
+
+    def delete_cart_line(self, username, line_key):
+        with self._tx() as conn:
+            conn.execute("delete from carts where username = ? and line_key = ?", (username, line_key))
+
+    def delete_cart(self, username):
+        with self._tx() as conn:
+            conn.execute("delete from carts where username = ?", (username,))
+
+    def get_meta(self, key):
+        row = self._one("select value from app_meta where key = ?", (key,))
+        return row["value"] if row else None
+
+    def set_meta(self, key, value):
+        with self._tx() as conn:
+            conn.execute("insert into app_meta (key, value) values (?, ?)"
+                         " on conflict(key) do update set value = excluded.value", (key, value))
+
+    def data_versions(self):
+        return {r["tbl"]: r["version"] for r in self._query("select tbl, version from data_versions")}
+
+    def changes_since(self, table, seq):
+        floor = self.get_meta("changes_floor")
+        if floor and seq < int(floor):
+            return None
+        return self._query("select seq, row_id, deleted from data_changes where tbl = ? and seq > ? order by seq",
+                           (table, seq))
+
+    def fetch_rows(self, table, ids):
+        _check_columns(table, ("id",))
+        rows = []
+        for i in range(0, len(ids), 500):
+            chunk = list(ids[i:i+500])
+            rows.extend(self._query(f"select * from {table} where id in ({', '.join('?' * len(chunk))})", chunk))
+        return rows
+
+    def prune_changes(self, max_age_hours):
+        with self._tx() as conn:
+            floor = conn.execute("select max(seq) from data_changes where changed_at < datetime('now', ?)",
+                                 (f"-{max_age_hours} hours",)).fetchone()[0]
+            if floor is not None:
+                conn.execute("delete from data_changes where seq <= ?", (floor,))
+                conn.execute("insert into app_meta (key, value) values ('changes_floor', ?)"
+                             " on conflict(key) do update set value = excluded.value", (str(floor),))
+
+    def query_table(self, table, columns, sort, descending=False, filters=None,
+                    search=None, search_columns=(), offset=0, limit=25):
+        _check_columns(table, [*columns, sort, *(filters or {}), *search_columns])
+        where, params = ["1 = 1"], []
+        for col, value in (filters or {}).items():
+            where.append(f"{col} = ?")
+            params.append(value)
+        if search and search_columns:
+            like = "%" + re.sub(r"([\\%_])", r"\\\1", search) + "%"
+            where.append("(" + " or ".join(f"{col} like ? escape '\\'" for col in search_columns) + ")")
+            params.extend([like] * len(search_columns))
+        clause = " and ".join(where)
+        total  = self._one(f"select count(*) as n from {table} where {clause}", params)["n"]
+        rows   = self._query(f"select {', '.join(columns)} from {table} where {clause}"
+                             f" order by {sort} {'desc' if descending else 'asc'}, id limit ? offset ?",
+                             [*params, limit, offset])
+        return rows, total
+
+
+@st.cache_resource
+def get_storage() -> Storage:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    return SupabaseStorage(get_supabase())
+
+
+storage: Storage = get_storage()
+
+
+# ── CACHE PARTAGÉ (toutes sessions) ───────────────────────────
+CACHE_TTL            = float(os.getenv("KASSUA_CACHE_TTL", "30"))          # secondes
+CHANGE_POLL_INTERVAL = float(os.getenv("KASSUA_POLL_INTERVAL", "2"))       # secondes
+CHANGE_RETENTION     = float(os.getenv("KASSUA_CHANGE_RETENTION", "24"))   # heures
+
+
+class SharedTableCache:
+    """Instantanés en lecture seule des tables, partagés par toutes les sessions du processus.
+
+    - un seul chargement pour N sessions qui ratent le cache en même temps (single-flight) ;
+    - au-delà du TTL, l'ancien instantané est servi pendant qu'un thread le rafraîchit ;
+    - invalidate() est appelé par les chemins d'écriture : la lecture suivante attend des données fraîches ;
+    - poll() suit data_versions pour les tables de TRACKED_TABLES : les écritures des autres processus
+      arrivent en delta (lignes changées + pierres tombales) et le TTL ne sert plus que de filet.
+
+    Les listes renvoyées sont partagées : ne jamais les modifier en place.
+    """
+
+    def __init__(self, loader, ttl: float, feed=None):
+        self._loader   = loader
+        self._ttl      = ttl
+        self._feed     = feed   # Storage : data_versions / changes_since / fetch_rows / prune_changes
+        self._lock     = threading.Lock()
+        self._entries  = {}   # table -> (rows, loaded_at)
+        self._versions = {}   # table -> numéro de l'instantané courant
+        self._inflight = {}   # table -> threading.Event du chargement en cours
+        self._gen      = {}   # table -> compteur d'invalidations
+        self._listeners = defaultdict(list)   # table -> fn(upserted, deleted_ids, version)
+        self._cursors   = {}   # table -> dernier seq de data_changes intégré à l'instantané
+        self._poll_lock = threading.Lock()
+        self._polled_at = self._pruned_at = -math.inf
+
+    def get(self, table: str) -> list:
+        return self.snapshot(table)[0]
+
+    def snapshot(self, table: str):
+        """Renvoie (lignes, version) de façon cohérente."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(table)
+                if entry and time.monotonic() - entry[1] < self._ttl:
+                    return entry[0], self._versions[table]
+                event  = self._inflight.get(table)
+                leader = event is None
+                if leader:
+                    event = self._inflight[table] = threading.Event()
+                version = self._versions.get(table, 0)
+            if entry:
+                if leader:
+                    threading.Thread(target=self._refresh, args=(table, event), daemon=True).start()
+                return entry[0], version
+            if leader:
+                if not self._refresh(table, event):
+                    return [], self.version(table)
+            else:
+                event.wait(timeout=30)
+            with self._lock:
+                entry = self._entries.get(table)
+                if entry:
+                    return entry[0], self._versions[table]
+
+    def version(self, table: str) -> int:
+        return self._versions.get(table, 0)
+
+    def loaded(self, table: str) -> bool:
+        """Vrai si un instantané (même périmé) est disponible, faux si le dernier chargement a échoué."""
+        with self._lock:
+            return table in self._entries
+
+    def stamp(self, table: str) -> tuple:
+        """Change à chaque écriture locale ou rechargement, sans charger la table : clé des requêtes serveur."""
+        with self._lock:
+            return self._gen.get(table, 0), self._versions.get(table, 0)
+
+    def invalidate(self, *tables: str):
+        with self._lock:
+            for table in tables:
+                self._entries.pop(table, None)
+                self._gen[table] = self._gen.get(table, 0) + 1
+
+    def on_change(self, table: str, listener):
+        """Enregistre un index dérivé, notifié des deltas appliqués par apply()."""
+        self._listeners[table].append(listener)
+
+    def apply(self, table: str, upserted=(), deleted_ids=()):
+        """Applique une écriture locale à l'instantané (copie, jamais en place) au lieu de tout recharger."""
+        upserted = [r for r in upserted if r]
+        by_id    = {r.get('id'): r for r in upserted}
+        deleted  = set(deleted_ids)
+        with self._lock:
+            self._gen[table] = self._gen.get(table, 0) + 1
+            entry = self._entries.get(table)
+            if not entry:
+                return
+            rows = [by_id.pop(r.get('id'), r) for r in entry[0] if r.get('id') not in deleted]
+            rows.extend(by_id.values())
+            self._entries[table]  = (rows, entry[1])
+            version = self._versions[table] = self._versions.get(table, 0) + 1
+            listeners = list(self._listeners[table])
+        for listener in listeners:
+            listener(upserted, deleted, version)
+
+    def poll(self, interval: float, retention_hours: float) -> bool:
+        """Sonde data_versions (une requête, au plus une fois par intervalle et par processus).
+
+        Seules les tables dont la version a bougé relisent leurs lignes changées ; un sondage réussi
+        confirme la fraîcheur des instantanés. En cas d'échec, le TTL reprend la main.
+        """
+        now = time.monotonic()
+        if not self._cursors or now - self._polled_at < interval:
+            return False
+        if not self._poll_lock.acquire(blocking=False):   # une autre session sonde déjà
+            return False
+        try:
+            self._polled_at = now
+            versions = self._feed.data_versions()
+            for table, seen in list(self._cursors.items()):
+                if versions.get(table, 0) > seen:
+                    self._pull(table, seen)
+                with self._lock:
+                    entry = self._entries.get(table)
+                    if entry and table in self._cursors:
+                        self._entries[table] = (entry[0], now)
+            if now - self._pruned_at > 3600:
+                self._pruned_at = now
+                self._feed.prune_changes(retention_hours)
+            return True
+        except Exception:
+            return False
+        finally:
+            self._poll_lock.release()
+
+    def _pull(self, table: str, seen: int):
+        changes = self._feed.changes_since(table, seen)
+        if changes is None:
+            # journal purgé au-delà de notre curseur : seul un rechargement complet est sûr
+            with self._lock:
+                self._cursors.pop(table, None)
+            self.invalidate(table)
+            return
+        latest  = {c['row_id']: bool(c['deleted']) for c in changes}   # le dernier changement d'une ligne gagne
+        ids     = [i for i, deleted in latest.items() if not deleted]
+        rows    = self._feed.fetch_rows(table, ids) if ids else []
+        found   = {r.get('id') for r in rows}
+        # une ligne introuvable a été supprimée depuis le changement lu : même effet qu'une pierre tombale
+        deleted = {i for i, d in latest.items() if d or i not in found}
+        self.merge(table, rows, deleted, max((c['seq'] for c in changes), default=seen))
+
+    def merge(self, table: str, rows, deleted_ids, cursor: int):
+        """Intègre un delta distant ; ce que l'instantané contient déjà (écritures locales) est ignoré.
+
+        Une ligne modifiée est passée aux index dérivés comme supprimée puis réinsérée.
+        """
+        with self._lock:
+            self._cursors[table] = max(cursor, self._cursors.get(table, cursor))
+            entry = self._entries.get(table)
+            if not entry:
+                return
+            current = {r.get('id'): r for r in entry[0]}
+        fresh    = [r for r in rows if current.get(r.get('id')) != r]
+        replaced = {r.get('id') for r in fresh if r.get('id') in current}
+        gone     = {i for i in deleted_ids if i in current}
+        if fresh or gone:
+            self.apply(table, upserted=fresh, deleted_ids=gone | replaced)
+
+    def _feed_cursor(self, table: str):
+        """Position du flux avant un chargement complet ; None si la table n'est pas suivie ou le flux absent."""
+        if self._feed is None or table not in TRACKED_TABLES:
+            return None
+        try:
+            return self._feed.data_versions().get(table, 0)
+        except Exception:
+            return None
+
+    def _refresh(self, table: str, event: threading.Event) -> bool:
+        """Charge la table ; renvoie False si le chargement a échoué."""
+        gen = self._gen.get(table, 0)
+        # lu avant le chargement : un changement concurrent sera relu (sans effet s'il est déjà présent)
+        cursor = self._feed_cursor(table)
+        try:
+            rows = self._loader(table)
+        except Exception:
+            rows = None
+        with self._lock:
+            # une invalidation pendant le chargement rend ce résultat caduc
+            if rows is not None and self._gen.get(table, 0) == gen:
+                self._entries[table]  = (rows, time.monotonic())
+                self._versions[table] = self._versions.get(table, 0) + 1
+                if cursor is None:
+                    self._cursors.pop(table, None)
+                else:
+                    self._cursors[table] = cursor
+            self._inflight.pop(table, None)
+        event.set()
+        return rows is not None
+
+
+@st.cache_resource
+def get_shared_cache() -> SharedTableCache:
+    return SharedTableCache(storage.fetch_table, ttl=CACHE_TTL, feed=storage)
+
+
+shared_cache = get_shared_cache()
+
+
+# ── ÉCRITURES DIFFÉRÉES (write-behind) ───────────────────────
+WRITE_JOURNAL      = os.getenv("KASSUA_WRITE_JOURNAL", "kassua_writes.jsonl")
+WRITE_BATCH_SIZE   = int(os.getenv("KASSUA_WRITE_BATCH", "50"))
+WRITE_FLUSH_DELAY  = float(os.getenv("KASSUA_WRITE_DELAY", "0.5"))   # secondes
+
+
+class WriteBehindQueue:
+    """File d'écritures idempotentes vidée par un thread (paniers, mises à jour / suppressions de produits).
+
+    - enqueue() journalise la commande (JSONL en ajout seul + fsync) puis rend la main ;
+    - tant qu'elles attendent, les écritures d'une même ligne fusionnent (la dernière gagne,
+      les champs de produit se cumulent, vider un panier remplace ses lignes en attente) ;
+    - envoi par lots quand la file atteint WRITE_BATCH_SIZE ou après WRITE_FLUSH_DELAY ;
+    - échec : la commande en cause attend son backoff exponentiel (retry_at), ainsi que les commandes
+      suivantes du même panier / produit ; les autres continuent ; fichier .failed après MAX_ATTEMPTS ;
+    - au démarrage, les commandes du journal non acquittées sont rejouées.
+
+    Les insertions qui doivent renvoyer un id (produits, achats, checkout) restent synchrones.
+    """
+
+    MAX_ATTEMPTS = 10
+    MAX_BACKOFF  = 60.0
+
+    def __init__(self, store, journal_path: str, batch_size: int, delay: float, journal_lock=None):
+        self._store      = store
+        self._path       = journal_path
+        self._lock_file  = journal_lock   # voir claim_journal : gardé ouvert tant que la file vit
+        self._batch_size = batch_size
+        self._delay      = delay
+        self._cond       = threading.Condition()
+        self._pending    = {}     # clé de fusion -> commande (ordre d'arrivée conservé)
+        self._inflight   = []     # clés du lot en cours d'envoi
+        self._next_at    = None   # échéance du prochain envoi
+        self._failures   = 0      # échecs consécutifs (affichage)
+        self._seq        = 0
+        self._journal    = None
+        self.last_error  = None
+        self._replay()
+        threading.Thread(target=self._run, daemon=True, name="kassua-writer").start()
+
+    # -- API ------------------------------------------------------------
+    def enqueue(self, op: str, *args_list: dict):
+        """Journalise puis met en file une commande par dict d'arguments ; ne fait aucun appel réseau."""
+        with self._cond:
+            for args in args_list:
+                self._seq += 1
+                self._write({"seq": self._seq, "op": op, "args": args})
+                self._add({"op": op, "args": args, "seqs": [self._seq], "attempts": 0})
+            self._sync_journal()
+            if self._next_at is None:
+                self._next_at = time.monotonic() + self._delay
+            self._cond.notify_all()
+
+    def drain(self, timeout: float, match=None) -> bool:
+        """Envoie tout de suite les commandes dont la clé de fusion satisfait `match` (toutes par défaut)
+        et patiente jusqu'à `timeout` secondes ; True si aucune n'attend plus ni n'est en cours d'envoi.
+
+        Les commandes visées passent devant la file (ordre relatif conservé) : une écriture sans
+        rapport qui échoue en tête ne les retient pas. Si toutes celles qui restent attendent
+        leur backoff, renvoie False aussitôt au lieu de bloquer l'appelant.
+        """
+        match    = match or (lambda key: True)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now      = time.monotonic()
+                first    = {k: c for k, c in self._pending.items() if match(k)}
+                inflight = any(match(k) for k in self._inflight)
+                if not first and not inflight:
+                    return True
+                ready = [k for k in self._ready(now) if match(k)]
+                if not ready and not inflight:
+                    return False
+                if first and list(self._pending)[:len(first)] != list(first):
+                    self._pending = {**first, **{k: c for k, c in self._pending.items() if k not in first}}
+                if ready and (self._next_at is None or self._next_at > now):
+                    self._next_at = now
+                    self._cond.notify_all()
+                remaining = deadline - now
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending) + len(self._inflight)
+
+    # -- fusion -----------------------------------------------------------
+    @staticmethod
+    def _key(cmd: dict) -> tuple:
+        op, args = cmd["op"], cmd["args"]
+        if op in ("upsert_cart_line", "delete_cart_line"):
+            return ("cart", args["username"], args["line_key"])
+        if op == "delete_cart":
+            return ("cart", args["username"], None)
+        return ("product", args["id"])
+
+    @staticmethod
+    def _absorb(cmd: dict, previous: dict) -> dict:
+        """`cmd` remplace `previous` : journal des deux, et le backoff en cours n'est pas remis à zéro."""
+        return {**cmd, "seqs": previous["seqs"] + cmd["seqs"],
+                "attempts": max(previous["attempts"], cmd["attempts"]),
+                "retry_at": max(previous.get("retry_at", 0), cmd.get("retry_at", 0))}
+
+    def _add(self, cmd: dict):
+        key = self._key(cmd)
+        if cmd["op"] == "delete_cart":
+            for k in [k for k in self._pending if k[0] == "cart" and k[1] == key[1]]:
+                cmd = self._absorb(cmd, self._pending.pop(k))
+        previous = self._pending.pop(key, None)
+        if previous is not None:
+            if previous["op"] == cmd["op"] == "update_product":
+                fields = {**previous["args"]["fields"], **cmd["args"]["fields"]}
+                cmd = {**cmd, "args": {**cmd["args"], "fields": fields}}
+            elif previous["op"] == "delete_product":
+                cmd = {**cmd, "op": previous["op"], "args": previous["args"]}   # produit supprimé : mise à jour caduque
+            cmd = self._absorb(cmd, previous)
+        self._pending[key] = cmd
+
+    def _ready(self, now: float) -> list:
+        """Clés envoyables maintenant, dans l'ordre : hors backoff, et sans commande plus ancienne
+        du même panier (ou du même produit) qui attend le sien."""
+        ready, blocked = [], set()
+        for key, cmd in self._pending.items():
+            group = key[:2]
+            if group in blocked:
+                continue
+            if cmd.get("retry_at", 0) > now:
+                blocked.add(group)
+                continue
+            ready.append(key)
+        return ready
+
+    # -- envoi ------------------------------------------------------------
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now   = time.monotonic()
+                    ready = self._ready(now)
+                    if ready and (self._next_at is None or now >= self._next_at or len(ready) >= self._batch_size):
+                        break
+                    self._cond.wait(self._wait_time(now, ready))
+                batch = [self._pending.pop(key) for key in ready[:self._batch_size]]
+                self._inflight = [self._key(cmd) for cmd in batch]
+                self._next_at  = time.monotonic() + self._delay if self._pending else None
+            done, error = self._send(batch)
+            with self._cond:
+                self._inflight = []
+                acked = [seq for cmd in batch[:done] for seq in cmd["seqs"]]
+                failed = batch[done:]
+                if failed:
+                    self._failures += 1
+                    self.last_error = error
+                    # seule la commande en échec attend son backoff ; le reste du lot n'a pas été tenté
+                    attempts = failed[0]["attempts"] + 1
+                    backoff  = min(self._delay * 2 ** attempts, self.MAX_BACKOFF)
+                    head = failed[0] = {**failed[0], "attempts": attempts, "retry_at": time.monotonic() + backoff}
+                    if head["attempts"] >= self.MAX_ATTEMPTS:
+                        self._dead_letter(head, error)
+                        acked.extend(head["seqs"])
+                        failed = failed[1:]
+                    # les commandes échouées repassent devant, fusionnées avec celles arrivées entre-temps
+                    newer, self._pending = self._pending, {}
+                    for cmd in failed + list(newer.values()):
+                        self._add(cmd)
+                    self._next_at = time.monotonic() + self._delay if self._pending else None
+                else:
+                    self._failures = 0
+                    self.last_error = None
+                if acked:
+                    self._write({"ack": acked})
+                if not self._pending:
+                    self._compact()
+                self._sync_journal()
+                self._cond.notify_all()
+
+    def _wait_time(self, now: float, ready: list):
+        """Délai jusqu'au prochain envoi possible : échéance du lot, ou fin du premier backoff."""
+        times = [c["retry_at"] for c in self._pending.values() if c.get("retry_at", 0) > now]
+        if ready and self._next_at is not None:
+            times.append(self._next_at)
+        return max(0.0, min(times) - now) if times else None
+
+    def _send(self, batch: list) -> tuple:
+        """Exécute le lot dans l'ordre ; renvoie (nombre de commandes faites, erreur éventuelle)."""
+        done = 0
+        try:
+            while done < len(batch):
+                op, args = batch[done]["op"], batch[done]["args"]
+                if op in ("upsert_cart_line", "delete_product"):
+                    run = 1
+                    while done + run < len(batch) and batch[done + run]["op"] == op:
+                        run += 1
+                    items = [c["args"] for c in batch[done:done + run]]
+                    if op == "upsert_cart_line":
+                        self._store.upsert_cart_lines(items)
+                    else:
+                        self._store.delete_products([a["id"] for a in items])
+                    done += run
+                    continue
+                if op == "delete_cart_line":
+                    self._store.delete_cart_line(args["username"], args["line_key"])
+                elif op == "delete_cart":
+                    self._store.delete_cart(args["username"])
+                elif op == "update_product":
+                    self._store.update_product(args["id"], args["fields"])
+                else:
+                    raise ValueError(f"commande inconnue: {op}")
+                done += 1
+        except Exception as e:
+            return done, f"{type(e).__name__}: {e}"
+        return done, None
+
+    # -- journal ----------------------------------------------------------
+    def _write(self, record: dict):
+        if self._journal is None:
+            self._journal = open(self._path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(record, default=str) + "\n")
+
+    def _sync_journal(self):
+        if self._journal is not None:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def _compact(self):
+        # tout est acquitté : le journal peut repartir de zéro
+        if self._journal is not None:
+            self._journal.seek(0)
+            self._journal.truncate()
+
+    def _dead_letter(self, cmd: dict, error: str):
+        with open(self._path + ".failed", "a", encoding="utf-8") as f:
+            f.write(json.dumps({"op": cmd["op"], "args": cmd["args"], "error": error}, default=str) + "\n")
+
+    @staticmethod
+    def _read_journal(path: str):
+        """(commandes non acquittées dans l'ordre, plus grand seq) d'un journal."""
+        if not os.path.exists(path):
+            return [], 0
+        commands, acked = {}, set()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue        # dernière ligne tronquée par un arrêt brutal
+                if "ack" in record:
+                    acked.update(record["ack"])
+                else:
+                    commands[record["seq"]] = record
+        return [r for seq, r in commands.items() if seq not in acked], max(commands, default=0)
+
+    def _replay(self):
+        records, self._seq = self._read_journal(self._path)
+        for record in records:
+            self._add({"op": record["op"], "args": record["args"], "seqs": [record["seq"]], "attempts": 0})
+        if self._pending:
+            self._next_at = time.monotonic()
+
+    def adopt(self, path: str):
+        """Reprend dans ce journal les commandes non acquittées d'un processus arrêté, puis vide le sien."""
+        records, _ = self._read_journal(path)
+        for record in records:
+            self.enqueue(record["op"], record["args"])
+        if records:
+            open(path, "w").close()
+
+
+def lock_file(path: str):
+    """Verrou exclusif non bloquant sur path + '.lock' ; renvoie le fichier ouvert (le fermer libère
+    le verrou, la mort du processus aussi) ou None si un autre processus le tient."""
+    f = open(path + ".lock", "a+")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def claim_journal(base: str):
+    """Premier journal libre parmi base, base.1, base.2… : un journal par processus.
+
+    Renvoie (chemin, verrou) ; le verrou doit rester ouvert aussi longtemps que la file.
+    """
+    for slot in itertools.count():
+        path = base if slot == 0 else f"{base}.{slot}"
+        lock = lock_file(path)
+        if lock is not None:
+            return path, lock
+
+
+def orphan_journals(base: str, own: str):
+    """Journaux de processus arrêtés (libres de verrou) : chemins avec leur verrou, à fermer après reprise."""
+    slots = [base] + sorted(p for p in glob.glob(glob.escape(base) + ".*") if re.search(r"\.\d+$", p))
+    for path in slots:
+        if path != own and os.path.exists(path) and os.path.getsize(path):
+            lock = lock_file(path)
+            if lock is not None:
+                yield path, lock
+
+
+@st.cache_resource
+def get_write_queue() -> WriteBehindQueue:
+    # chaque processus (plusieurs workers sur le même dossier) écrit dans son propre journal
+    path, lock = claim_journal(WRITE_JOURNAL)
+    writer     = WriteBehindQueue(storage, path, WRITE_BATCH_SIZE, WRITE_FLUSH_DELAY, journal_lock=lock)
+    for orphan, orphan_lock in orphan_journals(WRITE_JOURNAL, path):
+        with orphan_lock:
+            writer.adopt(orphan)
+    return writer
+
+
+write_queue = get_write_queue()
+
+WRITE_KINDS = {"products": "product", "carts": "cart"}   # table -> préfixe des clés de fusion
+
+
+class WritesPending(Exception):
+    """Des écritures différées de la table ne sont pas encore en base (envoi en retard ou en backoff)."""
+
+
+def settle_writes(table: str):
+    """À appeler avant une lecture mise en cache servie par la base : attend l'envoi des écritures
+    différées de `table`, ou lève WritesPending.
+
+    L'instantané partagé (et donc les clés de cache version/stamp) change dès l'enqueue ; sans cela,
+    la requête partirait avant l'écriture et son résultat périmé resterait en cache sous la nouvelle clé.
+    drain rend la main tout de suite quand les écritures restantes sont toutes en backoff ; l'exception
+    sort de la fonction mise en cache (rien n'est gardé) et l'appelant lit la base sans cache.
+    """
+    kind = WRITE_KINDS.get(table)
+    if kind is not None and not write_queue.drain(LOAD_TIMEOUT, match=lambda key: key[0] == kind):
+        raise WritesPending(table)
+
+
 # ── USERS ─────────────────────────────────────────────────────
-def load_users() -> list:
+class UserIndex:
+    """Index mémoire username / email -> compte, construit une fois par version de l'instantané users."""
+
+    def __init__(self, users: list, version):
+        self.version     = version
+        self.by_username = {u.get('username'): u for u in users if u.get('username')}
+        self.by_email    = {u.get('email'): u for u in users if u.get('email')}
+
+    def find(self, login: str):
+        return self.by_username.get(login) or self.by_email.get(login)
+
+
+@st.cache_resource
+def _user_index_holder() -> dict:
+    return {}
+
+
+def get_user_index() -> UserIndex:
+    """Repli si la requête indexée échoue : instantané partagé, ou users.json en mode dégradé."""
+    users, version = shared_cache.snapshot("users")
+    if not users and os.path.exists('users.json'):
+        try:
+            with open('users.json', encoding='utf-8') as f:
+                users, version = json.load(f), 'json'
+        except Exception:
+            users = []
+    holder = _user_index_holder()
+    index  = holder.get('index')
+    if index is None or index.version != version:
+        index = holder['index'] = UserIndex(users, version)
+    return index
+
+
+def find_user(login: str):
+    """Compte dont le username ou l'email vaut `login` : requête indexée, sans charger la table."""
+    if not login:
+        return None
     try:
-        return _rows(supabase.table("users").select("*").execute())
-    except Exception:
-        return []
+        return storage.find_user(login)
+    except Exception as e:
+        st.warning(f"Erreur find_user: {e}")
+        return get_user_index().find(login)
 
 
-def save_users(users: list):
-    """Remplace entièrement la table users (logique démo)."""
+def insert_users(users: list) -> list:
+    """Insertion groupée (migration JSON uniquement)."""
+    saved = []
     try:
-        supabase.table("users").delete().neq("id", 0).execute()
-        if users:
-            supabase.table("users").insert(users).execute()
+        saved = storage.insert_users(users)
     except Exception as e:
-        st.warning(f"Erreur save_users: {e}")
+        st.warning(f"Erreur insert_users: {e}")
+    shared_cache.invalidate("users")
+    return saved
 
 
-def upsert_user(user: dict):
-    """Insère ou met à jour un utilisateur par username."""
+def upsert_user(user: dict, ignore_duplicates: bool = False):
+    """Insère ou met à jour un utilisateur par username.
+
+    Avec ignore_duplicates=True, un username déjà pris n'est pas écrasé et
+    la fonction renvoie None.
+    """
     try:
-        supabase.table("users").upsert(user, on_conflict="username").execute()
+        row = storage.upsert_user(user, ignore_duplicates=ignore_duplicates)
+        shared_cache.invalidate("users")
+        return row
     except Exception as e:
         st.warning(f"Erreur upsert_user: {e}")
+        return None
 
 
-# ── PRODUCTS ──────────────────────────────────────────────────
-def load_products() -> list:
+def update_user(username: str, fields: dict):
+    """Met à jour uniquement les champs donnés d'un utilisateur."""
     try:
-        return _rows(supabase.table("products").select("*").execute())
-    except Exception:
-        return []
+        row = storage.update_user(username, fields)
+        shared_cache.invalidate("users")
+        return row
+    except Exception as e:
+        st.warning(f"Erreur update_user: {e}")
+        return None
+
+
+# ── RESET TOKENS ──────────────────────────────────────────────
+RESET_TOKEN_TTL = timedelta(hours=1)
 
 
-def save_products_to_db(products: list):
+def create_reset_token(username: str):
+    """Enregistre un token de réinitialisation et purge les tokens expirés."""
+    now   = datetime.now()
+    token = secrets.token_urlsafe(16)
     try:
-        supabase.table("products").delete().neq("id", 0).execute()
-        if products:
-            # Supabase accepte jusqu'à 1000 lignes par insert ; on chunke si besoin
-            for i in range(0, len(products), 500):
-                supabase.table("products").insert(products[i:i+500]).execute()
+        storage.insert_reset_token({
+            "token": token, "username": username,
+            "expires_at": (now + RESET_TOKEN_TTL).isoformat()
+        }, purge_before=now.isoformat())
+        return token
     except Exception as e:
-        st.warning(f"Erreur save_products_to_db: {e}")
+        st.warning(f"Erreur create_reset_token: {e}")
+        return None
 
 
-def save_products():
-    products = st.session_state.get('products', [])
+def find_reset_token(token: str):
+    """Renvoie la ligne du token s'il existe et n'a pas expiré."""
     try:
-        save_products_to_db(products)
+        return storage.find_reset_token(token, valid_after=datetime.now().isoformat())
     except Exception:
-        try:
-            with open("p.json", "w", encoding="utf-8") as f:
-                json.dump(products, f, ensure_ascii=False, indent=2)
-        except Exception:
-            pass
+        return None
+
+
+def delete_reset_token(token: str):
+    try:
+        storage.delete_reset_token(token)
+    except Exception as e:
+        st.warning(f"Erreur delete_reset_token: {e}")
+
+
+# ── PRODUCTS ──────────────────────────────────────────────────
+def insert_product(product: dict):
+    """Insère un produit et renvoie la ligne créée (avec son id)."""
+    rows = insert_products([product])
+    return rows[0] if rows else None
+
+
+def insert_products(products: list) -> list:
+    saved = []
+    try:
+        saved = storage.insert_products(products)
+        shared_cache.apply("products", upserted=saved)
+    except Exception as e:
+        st.warning(f"Erreur insert_products: {e}")
+        shared_cache.invalidate("products")
+    return saved
+
+
+def update_product(product_id, fields: dict):
+    """Met à jour uniquement les champs modifiés d'un produit (instantané tout de suite, base en différé)."""
+    if not fields:
+        return None
+    current = next((p for p in shared_cache.get("products") if p.get('id') == product_id), None)
+    try:
+        write_queue.enqueue("update_product", {"id": product_id, "fields": fields})
+    except Exception as e:
+        st.warning(f"Erreur update_product: {e}")
+        return None
+    if current is None:
+        # absent de l'instantané (grille admin lue en base) : pas de ligne partielle dans le catalogue
+        shared_cache.invalidate("products")
+        return {'id': product_id, **fields}
+    row = {**current, **fields}
+    shared_cache.apply("products", upserted=[row])
+    return row
+
+
+def delete_product(product_id) -> bool:
+    return delete_products([product_id])
+
+
+def delete_products(product_ids: list) -> bool:
+    if not product_ids:
+        return True
+    try:
+        write_queue.enqueue("delete_product", *({"id": pid} for pid in product_ids))
+    except Exception as e:
+        st.warning(f"Erreur delete_products: {e}")
+        return False
+    shared_cache.apply("products", deleted_ids=product_ids)
+    return True
+
+
+# Lectures mises en cache : une erreur de stockage remonte à l'appelant (st.cache_data ne garde
+# pas les exceptions), sinon un résultat vide resterait en cache pendant CACHE_TTL.
+@st.cache_data(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def fetch_products_page(categorie, after_id, limit: int, version: int) -> list:
+    """Une page du catalogue (pagination par clé sur id) ; `version` sert de clé de cache."""
+    settle_writes("products")
+    return storage.query_products(categorie, after_id, limit)
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=64, show_spinner=False)
+def get_product_stats(categorie, version: int) -> dict:
+    """Agrégats calculés par la base : nombre de produits, prix moyen, nombre de villes."""
+    settle_writes("products")
+    return storage.product_stats(categorie)
 
 
 # ── PURCHASES ─────────────────────────────────────────────────
-def load_purchases() -> list:
+@st.cache_data(ttl=CACHE_TTL, max_entries=16, show_spinner=False)
+def get_top_products_by_category(limit: int, version: int) -> dict:
+    """Top `limit` produits achetés par catégorie, agrégés par la base : {categorie: [(produit, achats)]}."""
+    top = {}
+    for row in storage.top_products_by_category(limit):
+        top.setdefault(row.get('categorie') or 'inconnu', []).append((row.get('produit'), int(row.get('achats') or 0)))
+    return top
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=32, show_spinner=False)
+def get_sales_totals(start, end, version: int) -> dict:
+    """Unités vendues et chiffre d'affaires entre deux jours inclus (None = sans borne), lus dans sales_daily."""
+    totals = storage.sales_totals(start, end)
+    return {"units": int(totals.get("units") or 0), "revenue": float(totals.get("revenue") or 0)}
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=16, show_spinner=False)
+def get_sales_rollup(start: str, end: str, version: int) -> pd.DataFrame:
+    """Lignes de sales_daily entre deux jours inclus : le coût suit la période affichée, pas l'historique."""
+    rows  = storage.sales_rollup(start, end)
+    frame = pd.DataFrame.from_records(rows, columns=TABLE_COLUMNS["sales_daily"])
+    for col in ('units', 'revenue'):
+        frame[col] = pd.to_numeric(frame[col], errors='coerce').fillna(0)
+    return frame
+
+
+def sales_version() -> int:
+    """Clé de cache des agrégats de ventes : version de l'instantané purchases."""
+    return shared_cache.snapshot("purchases")[1]
+
+
+PERIOD_CODES = {'day': 'D', 'month': 'M'}
+
+
+def purchases_between(start, end, granularity: str = 'day') -> pd.DataFrame:
+    """Unités et chiffre d'affaires par jour ou par mois pour les périodes contenant start … end.
+
+    Lu dans sales_daily (coût proportionnel à la plage, pas à l'historique) ; les jours sont
+    convertis en datetime64 en une passe. Une ligne par période, vides comprises, index « periode ».
+    """
+    code    = PERIOD_CODES[granularity]
+    periods = pd.period_range(pd.Timestamp(start).to_period(code), pd.Timestamp(end).to_period(code), freq=code)
+    first, last = periods[0].start_time, periods[-1].end_time
+    sales   = get_sales_rollup(f"{first:%Y-%m-%d}", f"{last:%Y-%m-%d}", sales_version())
+    jours   = pd.to_datetime(sales['jour'], errors='coerce', format='%Y-%m-%d')
+    buckets = sales.groupby(jours.dt.to_period(code))[['units', 'revenue']].sum()
+    buckets = buckets.reindex(periods, fill_value=0).astype({'units': int, 'revenue': float})
+    buckets.index = buckets.index.astype(str).rename('periode')
+    return buckets
+
+
+def rebuild_sales_rollup() -> bool:
+    """Recalcule sales_daily à partir de tous les achats (backfill, restauration)."""
     try:
-        return _rows(supabase.table("purchases").select("*").execute())
-    except Exception:
+        storage.rebuild_sales_rollup()
+    except Exception as e:
+        st.warning(f"Erreur rebuild_sales_rollup: {e}")
+        return False
+    set_meta('sales_rollup_built', datetime.now().isoformat())
+    for cached in (get_sales_totals, get_sales_rollup, get_top_products_by_category):
+        cached.clear()
+    return True
+
+
+def record_purchases(purchases: list) -> list:
+    """Insère uniquement les nouveaux achats (un seul appel) et renvoie les lignes avec leur id."""
+    if not purchases:
+        return []
+    try:
+        saved = storage.insert_purchases(purchases)
+        shared_cache.apply("purchases", upserted=saved)
+        return saved
+    except Exception as e:
+        st.warning(f"Erreur record_purchases: {e}")
         return []
 
 
-def save_purchases(purchases: list):
+def checkout_order(username, purchases: list, idempotency_key: str):
+    """Commande atomique en un appel : achats insérés, panier en base vidé, id de commande renvoyé.
+
+    Rejouer la même clé (double clic, réponse perdue) renvoie la commande existante sans rien dupliquer
+    et vide le panier en base ; la clé dépend du contenu du panier (voir checkout_key).
+    """
+    # les écritures en file du panier de cet acheteur doivent passer avant sa suppression atomique,
+    # sinon elles feraient réapparaître les lignes achetées
+    if username and not write_queue.drain(LOAD_TIMEOUT, match=lambda key: key[:2] == ("cart", username)):
+        st.warning("Panier en cours d'enregistrement : réessayez dans un instant.")
+        return None
     try:
-        supabase.table("purchases").delete().neq("id", 0).execute()
-        if purchases:
-            for i in range(0, len(purchases), 500):
-                supabase.table("purchases").insert(purchases[i:i+500]).execute()
+        result = storage.checkout(username, purchases, idempotency_key)
+    except Exception as e:
+        st.warning(f"Erreur checkout_order: {e}")
+        return None
+    if not result.get('replayed'):
+        shared_cache.apply("purchases", upserted=result.get('purchases') or [])
+    return result
+
+
+def restore_purchases(purchases: list):
+    """Remplace entièrement la table purchases (restauration admin uniquement)."""
+    try:
+        storage.replace_purchases(purchases)
     except Exception as e:
-        st.warning(f"Erreur save_purchases: {e}")
+        st.warning(f"Erreur restore_purchases: {e}")
+    rebuild_sales_rollup()
+    shared_cache.invalidate("purchases")
 
 
 # ── CARTS ─────────────────────────────────────────────────────
-def load_carts_from_db() -> dict:
+CART_FIELDS = ['product_id','produit','prix','vendeur','contact','categorie','ville','date','quantity']
+
+
+def cart_line_key(item: dict) -> str:
+    """Identifiant stable d'une ligne de panier : (id produit, vendeur)."""
+    product_ref = item.get('product_id') or item.get('produit')
+    return f"{product_ref}|{item.get('vendeur') or '—'}"
+
+
+def load_user_cart(username: str) -> dict:
+    """Charge le panier d'un seul utilisateur : {line_key: item} (ordre d'insertion conservé)."""
     try:
-        rows = _rows(supabase.table("carts").select("*").execute())
-        carts: dict = {}
-        for r in rows:
-            user = r.get("username")
-            item = {k: r.get(k) for k in
-                    ['produit','prix','vendeur','contact','categorie','ville','date','quantity']}
-            item['quantity'] = item.get('quantity') or 1
-            carts.setdefault(user, []).append(item)
-        return carts
+        return cart_from_rows(storage.load_cart(username))
     except Exception:
         return {}
 
 
-def _persist_user_cart(username: str):
-    """Écrase les lignes du panier d'un utilisateur dans Supabase."""
+def cart_from_rows(rows: list) -> dict:
+    cart: dict = {}
+    for r in rows:
+        item = {k: r.get(k) for k in CART_FIELDS}
+        item['quantity'] = item.get('quantity') or 1
+        cart[r.get("line_key") or cart_line_key(item)] = item
+    return cart
+
+
+def _cart_row(username: str, item: dict) -> dict:
+    return {
+        "username": username,
+        "line_key": cart_line_key(item),
+        "product_id": item.get('product_id'),
+        "produit": item.get('produit'),
+        "prix": str(item.get('prix','')),
+        "vendeur": item.get('vendeur'),
+        "contact": item.get('contact'),
+        "categorie": item.get('categorie'),
+        "ville": item.get('ville'),
+        "date": item.get('date'),
+        "quantity": int(item.get('quantity', 1))
+    }
+
+
+def _upsert_cart_lines(username: str, items: list):
+    """Écrit uniquement les lignes modifiées (upsert sur username + line_key), via la file différée."""
+    if not items:
+        return
     try:
-        supabase.table("carts").delete().eq("username", username).execute()
-        items = st.session_state.user_carts.get(username, [])
-        if items:
-            rows = [
-                {
-                    "username": username,
-                    "produit": it.get('produit'),
-                    "prix": str(it.get('prix','')),
-                    "vendeur": it.get('vendeur'),
-                    "contact": it.get('contact'),
-                    "categorie": it.get('categorie'),
-                    "ville": it.get('ville'),
-                    "date": it.get('date'),
-                    "quantity": int(it.get('quantity', 1))
-                }
-                for it in items
-            ]
-            supabase.table("carts").insert(rows).execute()
+        write_queue.enqueue("upsert_cart_line", *(_cart_row(username, it) for it in items))
     except Exception as e:
-        st.warning(f"Erreur _persist_user_cart: {e}")
+        st.warning(f"Erreur _upsert_cart_lines: {e}")
+
+
+def _delete_cart_line(username: str, line_key: str):
+    try:
+        write_queue.enqueue("delete_cart_line", {"username": username, "line_key": line_key})
+    except Exception as e:
+        st.warning(f"Erreur _delete_cart_line: {e}")
+
+
+def _delete_user_cart(username: str):
+    try:
+        write_queue.enqueue("delete_cart", {"username": username})
+    except Exception as e:
+        st.warning(f"Erreur _delete_user_cart: {e}")
 
 
 # ── INIT + MIGRATION ──────────────────────────────────────────
+def get_meta(key: str):
+    try:
+        return storage.get_meta(key)
+    except Exception:
+        return None
+
+
+def set_meta(key: str, value: str):
+    try:
+        storage.set_meta(key, value)
+    except Exception as e:
+        st.warning(f"Erreur set_meta: {e}")
+
+
 def migrate_json_to_db():
-    """Importe les anciens fichiers JSON dans Supabase si les tables sont vides."""
-    # Users
-    if not load_users() and os.path.exists('users.json'):
-        try:
-            with open('users.json', encoding='utf-8') as f:
-                save_users(json.load(f))
-        except Exception:
-            pass
-    # Products
-    if not load_products() and os.path.exists('p.json'):
+    """Importe les anciens fichiers JSON dans la base si les tables sont vides."""
+    sources = [('users', 'users.json', insert_users),
+               ('products', 'p.json', insert_products),
+               ('purchases', 'purchases.json', record_purchases)]
+    pending = [src for src in sources if os.path.exists(src[1])]
+    if not pending or get_meta('json_migrated'):
+        return
+    for table, file, insert in pending:
+        if not storage.is_empty(table):
+            continue
         try:
-            with open('p.json', encoding='utf-8') as f:
-                save_products_to_db(json.load(f))
+            with open(file, encoding='utf-8') as f:
+                insert(json.load(f))
         except Exception:
             pass
-    # Purchases
-    if not load_purchases() and os.path.exists('purchases.json'):
+    set_meta('json_migrated', datetime.now().isoformat())
+
+
+@st.cache_resource
+def run_startup_migration() -> bool:
+    """Exécute la migration une seule fois par processus (et non à chaque rerun)."""
+    migrate_json_to_db()
+    if not get_meta('sales_rollup_built'):
+        rebuild_sales_rollup()
+    return True
+
+
+@st.cache_resource
+def get_load_pool() -> ThreadPoolExecutor:
+    """Pool borné partagé par toutes les sessions pour les lectures indépendantes."""
+    return ThreadPoolExecutor(max_workers=LOAD_WORKERS, thread_name_prefix="kassua-load")
+
+
+def _load_snapshot(table: str) -> list:
+    # exécuté dans le pool : aucun appel st.* ici
+    rows, _ = shared_cache.snapshot(table)
+    if not shared_cache.loaded(table):
+        raise RuntimeError(f"chargement de {table} impossible")
+    return rows
+
+
+def load_concurrently(jobs: dict, timeout: float = None) -> tuple:
+    """Exécute {nom: (fn, *args)} en parallèle ; renvoie (résultats, noms en échec ou hors délai).
+
+    Une lecture hors délai continue en arrière-plan et remplit le cache partagé pour le rerun suivant.
+    """
+    futures = {get_load_pool().submit(fn, *args): name for name, (fn, *args) in jobs.items()}
+    done, pending = wait(futures, timeout=LOAD_TIMEOUT if timeout is None else timeout)
+    results, degraded = {}, {futures[f] for f in pending}
+    for future in done:
         try:
-            with open('purchases.json', encoding='utf-8') as f:
-                save_purchases(json.load(f))
+            results[futures[future]] = future.result()
         except Exception:
-            pass
+            degraded.add(futures[future])
+    return results, degraded
+
+
+def refresh_session_data():
+    """Fait pointer la session sur les instantanés partagés courants (références, pas de copies).
+
+    Les lectures partent en parallèle : le temps d'attente est celui de la plus lente, pas la somme.
+    Une source indisponible garde la valeur précédente et est listée dans st.session_state.degraded.
+    Le sondage de data_versions fait d'abord entrer les écritures des autres sessions / processus.
+    """
+    shared_cache.poll(CHANGE_POLL_INTERVAL, CHANGE_RETENTION)
+    jobs = {'products': (_load_snapshot, 'products'), 'purchases': (_load_snapshot, 'purchases')}
+    user = st.session_state.get('current_user')
+    if user and user not in st.session_state.user_carts:
+        jobs['cart'] = (storage.load_cart, user)
+    results, degraded = load_concurrently(jobs)
+    for table in ('products', 'purchases'):
+        if table in results:
+            st.session_state[table] = results[table]
+    if 'cart' in results:
+        st.session_state.user_carts[user] = cart_from_rows(results['cart'])
+    st.session_state.degraded = sorted(degraded)
 
 
 try:
-    migrate_json_to_db()
-    if not st.session_state.get('products'):
-        st.session_state.products = load_products()
-    if not st.session_state.get('users'):
-        st.session_state.users = load_users()
-    if not st.session_state.get('purchases'):
-        st.session_state.purchases = load_purchases()
-    st.session_state.user_carts = load_carts_from_db()
+    run_startup_migration()
+    refresh_session_data()
+    if st.session_state.degraded:
+        st.warning(f"Mode dégradé : {', '.join(st.session_state.degraded)} indisponible(s), "
+                   "données partielles. Nouvel essai au prochain rechargement.")
 except Exception as e:
     st.warning(f"Initialisation partielle: {e}")
-    for k, file in [('products','p.json'), ('users','users.json'), ('purchases','purchases.json')]:
+    for k, file in [('products','p.json'), ('purchases','purchases.json')]:
         if not st.session_state.get(k) and os.path.exists(file):
             try:
                 with open(file, encoding='utf-8') as f:
@@ -335,19 +1953,50 @@ def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode("utf-8")).hexdigest()
 
 
-def get_emoji(product_name):
-    for key, emoji in PRODUCT_EMOJIS.items():
-        if key in product_name.lower():
-            return emoji
-    return "📦"
+def fold_text(text) -> str:
+    """Minuscules sans accents : "Pastèque" → "pasteque", "Crème" → "creme"."""
+    decomposed = unicodedata.normalize("NFKD", str(text or "").lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _build_emoji_matcher():
+    """Une seule alternance regex (mots les plus longs d'abord) sur PRODUCT_EMOJIS + CATEGORIES."""
+    emojis = {}
+    for info in CATEGORIES.values():
+        for name in info["products"]:
+            emojis.setdefault(fold_text(name), info["emoji"])
+    emojis.update({fold_text(k): v for k, v in PRODUCT_EMOJIS.items() if v})
+    pattern = "|".join(re.escape(k) for k in sorted(emojis, key=len, reverse=True))
+    return re.compile(pattern), emojis
+
+
+EMOJI_RE, EMOJI_BY_KEYWORD = _build_emoji_matcher()
+
+
+@lru_cache(maxsize=4096)
+def get_emoji(product_name) -> str:
+    """Emoji du mot-clé le plus long trouvé : "pomme de terre" → 🥔 et non 🍎."""
+    best = ""
+    for m in EMOJI_RE.finditer(fold_text(product_name)):
+        if len(m.group()) > len(best):
+            best = m.group()
+    return EMOJI_BY_KEYWORD[best] if best else "📦"
+
+
+def classify_emojis(names) -> list:
+    """Version groupée de get_emoji : chaque nom distinct n'est classé qu'une fois."""
+    unique = {name: get_emoji(name) for name in dict.fromkeys(names)}
+    return [unique[name] for name in names]
+
+
+EMAIL_RE = re.compile(r"[\w\.-]+@[\w\.-]+\.[A-Za-z]{2,}")
 
 
 def contact_link(contact: str) -> str:
     if not contact:
         return "#"
-    import re
     s = str(contact).strip()
-    email_match = re.search(r"[\w\.-]+@[\w\.-]+\.[A-Za-z]{2,}", s)
+    email_match = EMAIL_RE.search(s)
     if "@" in s and email_match:
         return f"mailto:{email_match.group(0)}"
     digits = ''.join(c for c in s if c.isdigit() or c == '+')
@@ -357,6 +2006,280 @@ def contact_link(contact: str) -> str:
     return "#"
 
 
+# ── Recherche ─────────────────────────────────────────────────
+def _grams(text: str, n: int) -> set:
+    return {text[i:i+n] for i in range(len(text) - n + 1)}
+
+
+class CatalogSearchIndex:
+    """Index inversé du catalogue : trigrammes sur produit + ville, liste par catégorie.
+
+    La recherche garde la sémantique « sous-chaîne de produit ou de ville » de
+    l'ancien filtre, mais sans accents et classée (mot exact > début > milieu > ville).
+    """
+
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self.version = None
+        self._reset()
+
+    def _reset(self):
+        self._docs        = {}                 # id -> (produit plié, ville pliée)
+        self._products    = {}                 # id -> ligne produit
+        self._rank        = {}                 # id -> ordre d'insertion (départage stable)
+        self._grams       = defaultdict(set)   # n-gramme (1 à 3 caractères) -> ids
+        self._by_category = defaultdict(set)   # catégorie -> ids
+        self._next_rank   = 0
+
+    def rebuild(self, products: list, version):
+        with self._lock:
+            self._reset()
+            for i, p in enumerate(products):
+                self._add(p.get('id', i), p)
+            self.version = version
+
+    def sync(self, products: list, version):
+        """Reconstruit l'index si l'instantané a changé depuis la dernière synchro."""
+        if version != self.version:
+            self.rebuild(products, version)
+
+    def apply_delta(self, upserted, deleted_ids, version):
+        """Mise à jour incrémentale, si l'index est à jour avec la version précédente."""
+        with self._lock:
+            if self.version != version - 1:
+                return
+            for pid in deleted_ids:
+                self._remove(pid)
+            for p in upserted:
+                self._remove(p.get('id'))
+                self._add(p.get('id'), p)
+            self.version = version
+
+    def _add(self, pid, product):
+        name = fold_text(product.get('produit'))
+        city = fold_text(product.get('ville'))
+        self._docs[pid]     = (name, city)
+        self._products[pid] = product
+        self._rank[pid]     = self._next_rank
+        self._next_rank    += 1
+        for text in (name, city):
+            for n in (1, 2, 3):
+                for g in _grams(text, n):
+                    self._grams[g].add(pid)
+        self._by_category[product.get('categorie')].add(pid)
+
+    def _remove(self, pid):
+        doc = self._docs.pop(pid, None)
+        if doc is None:
+            return
+        product = self._products.pop(pid)
+        self._rank.pop(pid, None)
+        for text in doc:
+            for n in (1, 2, 3):
+                for g in _grams(text, n):
+                    self._grams[g].discard(pid)
+        self._by_category[product.get('categorie')].discard(pid)
+
+    def _score(self, pid, q: str) -> int:
+        name, city = self._docs[pid]
+        if q in name.split():
+            return 3
+        if name.startswith(q):
+            return 2
+        if q in name:
+            return 1
+        return 0 if q in city else -1
+
+    def search(self, query: str = "", categorie=None) -> list:
+        """Renvoie les produits correspondants, les plus pertinents d'abord."""
+        q = fold_text(query).strip()
+        with self._lock:
+            if categorie:
+                candidates = set(self._by_category.get(categorie, ()))
+            else:
+                candidates = None
+            if q:
+                keys = [q] if len(q) <= 3 else sorted(_grams(q, 3), key=lambda g: len(self._grams.get(g, ())))
+                for g in keys:
+                    posting = self._grams.get(g, set())
+                    candidates = set(posting) if candidates is None else candidates & posting
+                    if not candidates:
+                        return []
+                scored = [(self._score(pid, q), pid) for pid in candidates]
+                hits   = sorted(((sc, pid) for sc, pid in scored if sc >= 0),
+                                key=lambda t: (-t[0], self._rank[t[1]]))
+                return [self._products[pid] for _, pid in hits]
+            if candidates is None:
+                candidates = self._products.keys()
+            return [self._products[pid] for pid in sorted(candidates, key=self._rank.get)]
+
+
+@st.cache_resource
+def get_search_index() -> CatalogSearchIndex:
+    index = CatalogSearchIndex()
+    shared_cache.on_change("products", index.apply_delta)
+    return index
+
+
+def search_catalog(query: str = "", categorie=None) -> list:
+    """Recherche dans l'instantané partagé du catalogue via l'index (reconstruit si la version a changé)."""
+    products, version = shared_cache.snapshot("products")
+    index = get_search_index()
+    index.sync(products, version)
+    return index.search(query, categorie)
+
+
+# ── Catalogue colonnaire ─────────────────────────────────────
+PRODUCT_COLUMNS = ['id', 'produit', 'ville', 'prix', 'date', 'categorie', 'vendeur', 'contact']
+
+
+class CatalogColumns:
+    """Vue typée du catalogue, matérialisée une fois par version de l'instantané.
+
+    prix en Int64 (FCFA, <NA> si absent ou illisible : exclu des sommes et moyennes),
+    ville / categorie / vendeur en catégoriels, lignes adressées par id ; les agrégats
+    des tableaux de bord sont précalculés.
+    """
+
+    def __init__(self, products: list, version):
+        self.version = version
+        frame = pd.DataFrame.from_records(products, columns=PRODUCT_COLUMNS)
+        prices = pd.to_numeric(frame['prix'], errors='coerce')
+        prices = prices.where(np.isfinite(prices)).round()
+        frame['prix'] = prices.astype('Int64')
+        for col in ('ville', 'categorie', 'vendeur'):
+            frame[col] = frame[col].astype('category')
+        self.frame     = frame
+        self.positions = {pid: i for i, pid in enumerate(frame['id'].tolist())}
+        self._valid    = prices.notna().to_numpy()
+        self._prices   = prices.fillna(0).to_numpy(dtype=np.int64)   # lire avec _valid
+        self._cities   = frame['ville'].cat.codes.to_numpy()
+
+        self.count              = len(frame)
+        self.price_sum          = int(self._prices.sum())
+        self.price_mean         = self._mean_price(self._valid)
+        self.n_cities           = int(frame['ville'].nunique())
+        self.category_counts    = frame['categorie'].value_counts()
+        self.category_counts    = self.category_counts[self.category_counts > 0]
+        self.mean_price_by_city = (frame.assign(prix=prices).groupby('ville', observed=True)['prix']
+                                   .mean().dropna())
+
+    def _mean_price(self, valid, pos=slice(None)):
+        """Prix moyen des lignes `pos` ayant un prix valide ; None s'il n'y en a aucune."""
+        prices = self._prices[pos][valid]
+        return float(prices.mean()) if prices.size else None
+
+    def stats_for_ids(self, ids) -> dict:
+        """Nombre, prix moyen et villes distinctes d'un sous-ensemble (vectorisé)."""
+        pos = np.fromiter((self.positions[i] for i in ids if i in self.positions), dtype=np.int64)
+        if not pos.size:
+            return {"count": 0, "avg_price": None, "cities": 0}
+        cities = self._cities[pos]
+        return {"count": int(pos.size),
+                "avg_price": self._mean_price(self._valid[pos], pos),
+                "cities": int(np.unique(cities[cities >= 0]).size)}
+
+
+@st.cache_resource
+def _catalog_columns_holder() -> dict:
+    return {}
+
+
+def get_catalog_columns() -> CatalogColumns:
+    products, version = shared_cache.snapshot("products")
+    holder  = _catalog_columns_holder()
+    columns = holder.get('columns')
+    if columns is None or columns.version != version:
+        columns = holder['columns'] = CatalogColumns(products, version)
+    return columns
+
+
+# ── Cartes produit ───────────────────────────────────────────
+def build_product_card(product: dict, emoji: str = None) -> dict:
+    """HTML de la carte, clé de widget et ligne de panier, calculés une fois par version du produit."""
+    if product.get('id') is not None:
+        key = f"p{product['id']}"
+    else:
+        key = hashlib.sha1(
+            f"{product.get('produit','')}-{product.get('vendeur','')}-"
+            f"{product.get('ville','')}-{product.get('prix','')}-{product.get('date','')}".encode()
+        ).hexdigest()[:10]
+    category = CATEGORIES.get(product.get('categorie'), {}).get('name', product.get('categorie'))
+    html = f"""
+    <div style='border:1px solid #ddd;border-radius:10px;padding:15px;
+                margin-bottom:10px;background-color:white;'>
+        <div style='font-size:40px;text-align:center;'>{emoji or get_emoji(product.get('produit',''))}</div>
+        <h3 style='text-align:center;'>{product.get('produit')}</h3>
+        <h2 style='color:#2E8B57;text-align:center;'>{product.get('prix')} FCFA</h2>
+        <p style='text-align:center;'>
+            📍 {product.get('ville')}<br>📅 {product.get('date')}<br>
+            📁 {category}<br>
+            👤 Vendeur: {product.get('vendeur','—')}<br>
+            📞 Contact: {product.get('contact','—')}<br>
+            <a href="{contact_link(product.get('contact',''))}" target="_blank">
+                Contacter le vendeur</a>
+        </p>
+    </div>"""
+    return {
+        'key': key, 'html': html, 'produit': product.get('produit'),
+        'cart_item': {
+            'product_id': product.get('id'),
+            'produit': product.get('produit'), 'prix': product.get('prix'),
+            'vendeur': product.get('vendeur','—'), 'contact': product.get('contact','—'),
+            'categorie': product.get('categorie'), 'ville': product.get('ville','—'),
+            'date': product.get('date','')
+        }
+    }
+
+
+class ProductCardCache:
+    """Cartes rendues par id produit, invalidées par les deltas du catalogue (comme l'index de recherche)."""
+
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self.version = None
+        self._cards  = {}
+
+    def sync(self, version):
+        with self._lock:
+            if version != self.version:
+                self._cards.clear()
+                self.version = version
+
+    def apply_delta(self, upserted, deleted_ids, version):
+        with self._lock:
+            if self.version != version - 1:
+                return
+            for pid in deleted_ids:
+                self._cards.pop(pid, None)
+            for p in upserted:
+                self._cards.pop(p.get('id'), None)
+            self.version = version
+
+    def cards(self, products: list) -> list:
+        # résultat construit dans un dict local : un sync / apply_delta d'une autre session
+        # peut vider self._cards entre la lecture et le rendu
+        with self._lock:
+            version = self.version
+            found   = {id(p): self._cards[p['id']] for p in products
+                       if p.get('id') is not None and p['id'] in self._cards}
+        missing = [p for p in products if id(p) not in found]
+        built   = {id(p): build_product_card(p, emoji)
+                   for p, emoji in zip(missing, classify_emojis([p.get('produit', '') for p in missing]))}
+        with self._lock:
+            if self.version == version:     # sinon ces cartes peuvent déjà être périmées
+                self._cards.update((p['id'], built[id(p)]) for p in missing if p.get('id') is not None)
+        found.update(built)
+        return [found[id(p)] for p in products]
+
+
+@st.cache_resource
+def get_card_cache() -> ProductCardCache:
+    cache = ProductCardCache()
+    shared_cache.on_change("products", cache.apply_delta)
+    return cache
+
+
 def generate_sample_data():
     products = []
     for cat_id, cat_info in CATEGORIES.items():
@@ -373,61 +2296,475 @@ def generate_sample_data():
     return products
 
 
+class RecommendationIndex:
+    """Affinité par catégorie : compteurs catégorie par acheteur + liste des produits par catégorie.
+
+    Reconstruit quand les instantanés changent, mis à jour en place quand des achats
+    sont enregistrés ; une recommandation coûte alors O(limit).
+    """
+
+    def __init__(self):
+        self._lock             = threading.Lock()
+        self.purchases_version = None
+        self.products_version  = None
+        self._user_categories  = defaultdict(Counter)   # acheteur -> Counter(catégorie)
+        self._category_names   = {}                     # catégorie -> noms de produits (uniques, ordre du catalogue)
+
+    def sync(self, purchases, purchases_version, products, products_version):
+        with self._lock:
+            if products_version != self.products_version:
+                names = defaultdict(dict)
+                for prod in products:
+                    if prod.get('produit'):
+                        names[prod.get('categorie')].setdefault(prod.get('produit'))
+                self._category_names  = {cat: list(d) for cat, d in names.items()}
+                self.products_version = products_version
+            if purchases_version != self.purchases_version:
+                self._user_categories = defaultdict(Counter)
+                self._add_purchases(purchases)
+                self.purchases_version = purchases_version
+
+    def apply_purchases(self, upserted, deleted_ids, version):
+        with self._lock:
+            if self.purchases_version != version - 1 or deleted_ids:
+                return
+            self._add_purchases(upserted)
+            self.purchases_version = version
+
+    def _add_purchases(self, purchases):
+        for p in purchases:
+            if p.get('categorie'):
+                self._user_categories[p.get('acheteur')][p.get('categorie')] += 1
+
+    def recommend(self, username: str, limit: int = 5) -> list:
+        with self._lock:
+            counts = self._user_categories.get(username)
+            if not counts:
+                return []
+            recs = []
+            for cat, _ in counts.most_common():
+                for name in self._category_names.get(cat, ()):
+                    if name not in recs:
+                        recs.append(name)
+                        if len(recs) >= limit:
+                            return recs
+            return recs
+
+
+@st.cache_resource
+def get_recommendation_index() -> RecommendationIndex:
+    index = RecommendationIndex()
+    shared_cache.on_change("purchases", index.apply_purchases)
+    return index
+
+
 def recommend_for_user(username: str, limit: int = 5):
     if not username:
         return []
-    purchases = st.session_state.get('purchases', [])
-    user_p = [p for p in purchases if p.get('acheteur') == username]
-    if not user_p:
+    index = get_recommendation_index()
+    index.sync(*shared_cache.snapshot("purchases"), *shared_cache.snapshot("products"))
+    return index.recommend(username, limit)
+
+
+class CoPurchaseEngine:
+    """Recommandations article → article (« ceux qui ont acheté X ont aussi acheté Y »).
+
+    Matrice creuse binaire acheteurs × produits ; similarité cosinus = co-achats
+    normalisés par la racine des degrés. Les k voisins de chaque produit sont
+    précalculés par blocs ; servir une recommandation est une lecture de dict.
+
+    Un nouvel achat ne coûte au thread d'enregistrement qu'un ajout dans des tampons
+    (COO extensibles, historique, degrés) ; les voisins des produits touchés sont
+    recalculés en tâche de fond, sur les seuls acheteurs de ces produits.
+    """
+
+    BLOCK = 2048
+
+    def __init__(self, k: int = 10):
+        self.k           = k
+        self.version     = None
+        self._lock       = threading.Lock()
+        self._building   = False
+        self._generation = 0     # incrémenté à chaque construction complète
+        self._buyers     = {}    # acheteur -> index de ligne
+        self._products   = {}    # produit -> index de colonne
+        self._names      = []    # index de colonne -> produit
+        self._rows       = np.empty(0, dtype=np.int64)   # tampons COO (capacité >= _size)
+        self._cols       = np.empty(0, dtype=np.int64)
+        self._size       = 0
+        self._degrees    = np.empty(0, dtype=np.int64)   # acheteurs distincts par produit
+        self._dirty      = set() # colonnes dont les voisins sont à recalculer
+        self._refreshing = False
+        self._neighbours = {}    # produit -> [produits voisins, du plus proche au moins proche]
+        self._history    = {}    # acheteur -> colonnes des produits achetés (ordre chronologique, sans doublons)
+
+    # -- construction -------------------------------------------------
+    def sync(self, purchases: list, version):
+        """Relance le calcul complet en tâche de fond quand l'instantané a changé."""
+        with self._lock:
+            if version == self.version or self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._build, args=(purchases, version), daemon=True).start()
+
+    def _build(self, purchases, version):
+        try:
+            df = pd.DataFrame.from_records(purchases, columns=['acheteur', 'produit']).dropna()
+            buyer_codes, buyers     = pd.factorize(df['acheteur'])
+            product_codes, products = pd.factorize(df['produit'])
+            pairs   = pd.DataFrame({'b': buyer_codes, 'p': product_codes}).drop_duplicates()
+            history = pairs.groupby('b', sort=False)['p'].agg(list)
+            buyers, products = buyers.tolist(), products.tolist()
+            rows, cols = buyer_codes.astype(np.int64), product_codes.astype(np.int64)
+            degrees    = np.bincount(pairs['p'].to_numpy(), minlength=len(products)).astype(np.int64)
+            matrix     = self._matrix_from(rows, cols, (len(buyers), len(products)))
+            neighbours = self._top_k(matrix, degrees, products, np.arange(len(products)))
+            with self._lock:
+                self._buyers     = {b: i for i, b in enumerate(buyers)}
+                self._products   = {p: i for i, p in enumerate(products)}
+                self._names      = products
+                self._rows, self._cols, self._size = rows, cols, len(rows)
+                self._degrees    = degrees
+                self._history    = {buyers[b]: items for b, items in history.items()}
+                self._neighbours = neighbours
+                self._dirty      = set()
+                self._generation += 1
+                self.version     = version
+        finally:
+            self._building = False
+
+    @staticmethod
+    def _matrix_from(rows, cols, shape):
+        matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+        matrix.data[:] = 1.0            # achats répétés du même produit : comptés une fois
+        return matrix
+
+    def _top_k(self, matrix, degrees, names, columns) -> dict:
+        """Top-k voisins des colonnes données, par blocs pour borner la mémoire.
+
+        `matrix` peut ne contenir que les acheteurs des colonnes demandées : leurs co-achats
+        n'en dépendent pas ; les normes viennent des degrés complets.
+        """
+        neighbours = {}
+        matrix_c   = matrix.tocsc()
+        norms      = np.sqrt(degrees.astype(np.float64))
+        for start in range(0, len(columns), self.BLOCK):
+            block = columns[start:start + self.BLOCK]
+            co    = (matrix_c.T @ matrix_c[:, block]).tocsc()   # produits × bloc
+            for j, col in enumerate(block):
+                lo, hi = co.indptr[j], co.indptr[j + 1]
+                rows, counts = co.indices[lo:hi], co.data[lo:hi]
+                keep = rows != col
+                rows, counts = rows[keep], counts[keep]
+                if len(rows) > self.k:
+                    scores = counts / norms[rows]          # la norme de la colonne est constante
+                    top    = np.argpartition(-scores, self.k)[:self.k]
+                    rows, counts = rows[top], counts[top]
+                scores = counts / (norms[rows] * norms[col])
+                neighbours[names[col]] = [names[r] for r in rows[np.argsort(-scores, kind='stable')]]
+        return neighbours
+
+    # -- mise à jour incrémentale ---------------------------------------
+    def apply_purchases(self, upserted, deleted_ids, version):
+        """Enregistre les nouveaux achats (O(achats)) et planifie le recalcul des produits touchés."""
+        with self._lock:
+            if self._building or self.version != version - 1 or deleted_ids:
+                return
+            rows, cols = [], []
+            for p in upserted:
+                buyer, name = p.get('acheteur'), p.get('produit')
+                if buyer is None or name is None:
+                    continue
+                b = self._buyers.setdefault(buyer, len(self._buyers))
+                if name not in self._products:
+                    self._products[name] = len(self._names)
+                    self._names.append(name)
+                col   = self._products[name]
+                items = self._history.setdefault(buyer, [])
+                if col not in items:
+                    items.append(col)
+                    if col >= len(self._degrees):
+                        self._degrees = np.concatenate([self._degrees,
+                                                        np.zeros(col + 1 - len(self._degrees), dtype=np.int64)])
+                    self._degrees[col] += 1
+                    self._dirty.update(items)
+                rows.append(b)
+                cols.append(col)
+            if rows:
+                self._append(rows, cols)
+            self.version = version
+            start = bool(self._dirty) and not self._refreshing
+            if start:
+                self._refreshing = True
+        if start:
+            threading.Thread(target=self._refresh_dirty, daemon=True).start()
+
+    def _append(self, rows, cols):
+        """Ajout amorti en O(1) : capacité doublée quand les tampons sont pleins."""
+        end = self._size + len(rows)
+        if end > len(self._rows):
+            capacity = max(end, 2 * len(self._rows), 1024)
+            for attr in ('_rows', '_cols'):
+                grown = np.empty(capacity, dtype=np.int64)
+                grown[:self._size] = getattr(self, attr)[:self._size]
+                setattr(self, attr, grown)
+        self._rows[self._size:end] = rows
+        self._cols[self._size:end] = cols
+        self._size = end
+
+    def _refresh_dirty(self):
+        """Recalcule les voisins des produits touchés, hors verrou, jusqu'à épuisement."""
+        while True:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                if not dirty or self._building:
+                    self._refreshing = False
+                    return
+                # vues figées : les ajouts suivants écrivent au-delà de _size ou dans un nouveau tampon
+                rows, cols = self._rows[:self._size], self._cols[:self._size]
+                degrees    = self._degrees.copy()
+                names      = list(self._names)
+                generation = self._generation
+            columns   = np.fromiter(sorted(dirty), dtype=np.int64)
+            buyers    = np.unique(rows[np.isin(cols, columns)])
+            keep      = np.isin(rows, buyers)
+            sub       = self._matrix_from(np.searchsorted(buyers, rows[keep]), cols[keep],
+                                          (len(buyers), len(names)))
+            neighbours = self._top_k(sub, degrees, names, columns)
+            with self._lock:
+                if generation == self._generation:
+                    self._neighbours.update(neighbours)
+
+    # -- service --------------------------------------------------------
+    def neighbours(self, product: str) -> list:
+        return self._neighbours.get(product, [])
+
+    def recommend(self, username: str, limit: int = 5, recent: int = 5) -> list:
+        """Voisins des derniers produits achetés, hors produits déjà achetés."""
+        # copies sous verrou : apply_purchases / _build modifient l'historique et les noms en place
+        with self._lock:
+            owned   = [self._names[c] for c in self._history.get(username, ())]
+            nearest = [self._neighbours.get(name, ()) for name in reversed(owned[-recent:])]
+        already = set(owned)
+        recs    = []
+        for neighbours in nearest:
+            for other in neighbours:
+                if other not in already and other not in recs:
+                    recs.append(other)
+                    if len(recs) >= limit:
+                        return recs
+        return recs
+
+
+@st.cache_resource
+def get_copurchase_engine() -> CoPurchaseEngine:
+    engine = CoPurchaseEngine()
+    shared_cache.on_change("purchases", engine.apply_purchases)
+    return engine
+
+
+def recommend_copurchases(username: str, limit: int = 5) -> list:
+    if not username:
         return []
-    from collections import Counter
-    cat_counts = Counter(p.get('categorie') for p in user_p if p.get('categorie'))
-    recs = []
-    for cat, _ in cat_counts.most_common():
-        for prod in st.session_state.get('products', []):
-            if prod.get('categorie') == cat and prod.get('produit') not in recs:
-                recs.append(prod.get('produit'))
-                if len(recs) >= limit:
-                    return recs
-    return recs
+    engine = get_copurchase_engine()
+    engine.sync(*shared_cache.snapshot("purchases"))
+    return engine.recommend(username, limit)
+
+
+class PopularityIndex:
+    """Meilleures ventes : compteurs maintenus à l'enregistrement + top-K en cache.
+
+    Les achats étant en ajout seul, les scores ne font que croître : un incrément
+    ne touche le top-K que si le produit y est déjà ou y entre. Les fenêtres
+    glissantes (7/30 jours) sont des compteurs à décroissance exponentielle, stockés
+    à l'échelle d'un instant de référence fixe pour que l'incrément reste O(1) et
+    que le classement ne dépende pas de l'heure de lecture.
+    """
+
+    K       = 20
+    WINDOWS = {None: None, 7: 7 * 86400, 30: 30 * 86400}   # jours -> constante de temps (s)
+
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self.version = None
+        self._reset()
+
+    def _reset(self):
+        self._origin = time.time()
+        self._scores = {w: defaultdict(float) for w in self.WINDOWS}
+        self._top    = {w: [] for w in self.WINDOWS}   # [(score, produit)] trié décroissant
+
+    def sync(self, purchases: list, version):
+        """Reconstruction complète, vectorisée et hors verrou (une passe pd.to_datetime)."""
+        with self._lock:
+            if version == self.version:
+                return
+        frame   = pd.DataFrame.from_records(purchases, columns=['produit', 'date_achat'])
+        frame   = frame[frame['produit'].notna() & (frame['produit'] != '')]
+        origin  = time.time()
+        # ISO 8601 comme datetime.fromisoformat dans _count() ; illisible -> instant de référence
+        stamps  = pd.to_datetime(frame['date_achat'], errors='coerce', format='ISO8601', utc=True)
+        seconds = ((stamps - pd.Timestamp(0, tz='UTC')).dt.total_seconds()).fillna(origin).to_numpy()
+        codes, names = pd.factorize(frame['produit'])
+        names   = names.tolist()
+        scores, top = {}, {}
+        for w, tau in self.WINDOWS.items():
+            weights   = None if tau is None else np.exp((seconds - origin) / tau)
+            sums      = np.bincount(codes, weights=weights, minlength=len(names)).astype(float)
+            scores[w] = defaultdict(float, zip(names, sums.tolist()))
+            top[w]    = heapq.nlargest(self.K, ((s, name) for name, s in scores[w].items()))
+        with self._lock:
+            self._origin, self._scores, self._top = origin, scores, top
+            self.version = version
+
+    def apply_purchases(self, upserted, deleted_ids, version):
+        with self._lock:
+            if self.version != version - 1 or deleted_ids:
+                return
+            for p in upserted:
+                for w, name, score in self._count(p):
+                    self._bump_top(w, name, score)
+            self.version = version
+
+    def _count(self, purchase):
+        name = purchase.get('produit')
+        if not name:
+            return []
+        try:
+            stamp = datetime.fromisoformat(str(purchase.get('date_achat')))
+            # date sans fuseau = UTC, comme pd.to_datetime(utc=True) dans sync()
+            ts = (stamp if stamp.tzinfo else stamp.replace(tzinfo=timezone.utc)).timestamp()
+        except ValueError:
+            ts = self._origin
+        changed = []
+        for w, tau in self.WINDOWS.items():
+            weight = 1.0 if tau is None else math.exp((ts - self._origin) / tau)
+            self._scores[w][name] += weight
+            changed.append((w, name, self._scores[w][name]))
+        return changed
+
+    def _bump_top(self, window, name, score):
+        top = [entry for entry in self._top[window] if entry[1] != name]
+        if len(top) < self.K or score > top[-1][0] or len(top) < len(self._top[window]):
+            top.append((score, name))
+            top.sort(reverse=True)
+            del top[self.K:]
+            self._top[window] = top
+
+    def top(self, n: int = 5, window=None) -> list:
+        with self._lock:
+            if n <= self.K:
+                return [name for _, name in self._top[window][:n]]
+            scores = self._scores[window]
+            return [name for _, name in heapq.nlargest(n, ((s, name) for name, s in scores.items()))]
+
+
+@st.cache_resource
+def get_popularity_index() -> PopularityIndex:
+    index = PopularityIndex()
+    shared_cache.on_change("purchases", index.apply_purchases)
+    return index
+
+
+def get_global_top_products(n=5, window=None):
+    """Produits les plus vendus ; window=7 ou 30 pour les tendances récentes (jours)."""
+    index = get_popularity_index()
+    index.sync(*shared_cache.snapshot("purchases"))
+    return index.top(n, window)
 
 
-def get_purchase_counts():
-    from collections import Counter
-    return Counter(p.get('produit') for p in st.session_state.get('purchases', []) if p.get('produit'))
+# ── Panier ────────────────────────────────────────────────────
+# Un panier est un dict {line_key: item} : fusion et suppression en O(1),
+# et seule la ligne modifiée est envoyée à la base.
+def get_user_cart(username: str) -> dict:
+    """Panier de l'utilisateur, chargé à la demande puis gardé en session."""
+    carts = st.session_state.user_carts
+    if username not in carts:
+        carts[username] = load_user_cart(username)
+    return carts[username]
 
 
-def get_global_top_products(n=5):
-    return [p for p, _ in get_purchase_counts().most_common(n)]
+def get_active_cart() -> dict:
+    user = st.session_state.get('current_user')
+    if user:
+        return get_user_cart(user)
+    return st.session_state.cart
 
 
-# ── Panier ────────────────────────────────────────────────────
 def add_to_cart_item(item):
+    cart = get_active_cart()
+    key  = cart_line_key(item)
+    line = cart.get(key)
+    if line:
+        try:
+            line['quantity'] = int(line.get('quantity', 1)) + int(item.get('quantity', 1))
+        except Exception:
+            line['quantity'] = 1
+    else:
+        item.setdefault('quantity', 1)
+        line = cart[key] = item
     user = st.session_state.get('current_user')
     if user:
-        if user not in st.session_state.user_carts:
-            st.session_state.user_carts[user] = []
-        merged = False
-        for it in st.session_state.user_carts[user]:
-            if it.get('produit') == item.get('produit') and it.get('vendeur') == item.get('vendeur'):
-                try:
-                    it['quantity'] = int(it.get('quantity', 1)) + int(item.get('quantity', 1))
-                except Exception:
-                    it['quantity'] = 1
-                merged = True
-                break
-        if not merged:
-            item.setdefault('quantity', 1)
-            st.session_state.user_carts[user].append(item)
-        _persist_user_cart(user)
+        _upsert_cart_lines(user, [line])
+
+
+def set_cart_quantity(line_key: str, quantity: int):
+    line = get_active_cart().get(line_key)
+    if not line:
+        return
+    line['quantity'] = int(quantity)
+    user = st.session_state.get('current_user')
+    if user:
+        _upsert_cart_lines(user, [line])
+
+
+def remove_cart_line(line_key: str):
+    if get_active_cart().pop(line_key, None) is None:
+        return
+    user = st.session_state.get('current_user')
+    if user:
+        _delete_cart_line(user, line_key)
+
+
+def checkout_key(nonce: str, cart: dict) -> str:
+    """Clé d'idempotence d'une commande : jeton de session + lignes du panier (clé, quantité, prix)."""
+    lines = sorted((key, item.get('quantity', 1), str(item.get('prix'))) for key, item in cart.items())
+    return hashlib.sha256(json.dumps([nonce, lines]).encode("utf-8")).hexdigest()
+
+
+def clear_cart(persist: bool = True):
+    """Vide le panier actif ; persist=False quand les lignes en base sont déjà supprimées (checkout)."""
+    user = st.session_state.get('current_user')
+    if user:
+        st.session_state.user_carts[user] = {}
+        if persist:
+            _delete_user_cart(user)
     else:
-        st.session_state.cart.append(item)
+        st.session_state.cart = {}
+
+
+def merge_anon_cart(username: str):
+    """Fusionne le panier anonyme dans celui de l'utilisateur (un seul upsert groupé)."""
+    anon_cart = st.session_state.get('cart') or {}
+    if not anon_cart:
+        return
+    user_cart = get_user_cart(username)
+    touched = []
+    for key, item in anon_cart.items():
+        line = user_cart.get(key)
+        if line:
+            line['quantity'] = int(line.get('quantity', 1)) + int(item.get('quantity', 1))
+        else:
+            line = user_cart[key] = item
+        touched.append(line)
+    st.session_state.cart = {}
+    _upsert_cart_lines(username, touched)
 
 
 def render_cart_badge():
     try:
         user = st.session_state.get('current_user')
-        count = len(st.session_state.user_carts.get(user, [])) if user else len(st.session_state.get('cart', []))
+        count = len(get_active_cart())
         if count:
             cols = st.columns([9, 1])
             with cols[1]:
@@ -446,8 +2783,7 @@ def render_cart_preview():
         container = st.container()
         with container:
             st.markdown("**Aperçu du panier**")
-            current_user = st.session_state.get('current_user')
-            cart = st.session_state.user_carts.get(current_user, []) if current_user else st.session_state.get('cart', [])
+            cart = get_active_cart()
             if not cart:
                 st.info("Votre panier est vide.")
                 if st.button("Voir le panier", key="preview_view_cart"):
@@ -464,7 +2800,7 @@ def render_cart_preview():
                         pass
                 return
             total_preview = 0.0
-            for i, item in enumerate(cart):
+            for key, item in list(cart.items()):
                 cols = st.columns([3, 1, 1])
                 with cols[0]:
                     st.write(f"{item.get('produit')} — {item.get('vendeur','—')}")
@@ -475,15 +2811,8 @@ def render_cart_preview():
                         price_val = 0.0
                     st.write(f"{price_val:.0f} FCFA")
                 with cols[2]:
-                    if st.button("Supprimer", key=f"preview_remove_{i}"):
-                        if current_user:
-                            st.session_state.user_carts[current_user].pop(i)
-                            _persist_user_cart(current_user)
-                        else:
-                            try:
-                                st.session_state.cart.pop(i)
-                            except Exception:
-                                pass
+                    if st.button("Supprimer", key=f"preview_remove_{key}"):
+                        remove_cart_line(key)
                         st.success("Article supprimé.")
                         st.session_state.show_cart_preview = True
                         try:
@@ -516,32 +2845,25 @@ def render_cart_preview():
 
 # ── Reset password ────────────────────────────────────────────
 def generate_reset_token_for_email(email: str):
-    users = st.session_state.get('users', [])
-    user = next((u for u in users if u.get('email') == email), None)
-    if not user:
+    user = find_user(email)
+    if not user or user.get('email') != email:
         return None
-    token = secrets.token_urlsafe(16)
-    user['reset_token'] = token
-    user['reset_expires'] = (datetime.now() + timedelta(hours=1)).isoformat()
-    save_users(users)
-    return token
+    return create_reset_token(user.get('username'))
 
 
-def verify_reset_token(email: str, token: str) -> bool:
-    user = next((u for u in st.session_state.get('users', [])
-                 if u.get('email') == email and u.get('reset_token') == token), None)
-    if not user:
-        return False
-    try:
-        return datetime.fromisoformat(user.get('reset_expires', '')) >= datetime.now()
-    except Exception:
-        return False
+def verify_reset_token(email: str, token: str):
+    """Renvoie l'utilisateur associé si le token est valide pour cet email, sinon None."""
+    row = find_reset_token(token)
+    if not row:
+        return None
+    user = find_user(row.get('username'))
+    if user and user.get('username') == row.get('username') and user.get('email') == email:
+        return user
+    return None
 
 
-def clear_reset_token_for_user(user: dict):
-    user.pop('reset_token', None)
-    user.pop('reset_expires', None)
-    save_users(st.session_state.get('users', []))
+def clear_reset_token(token: str):
+    delete_reset_token(token)
 
 
 # ═══════════════════════════════════════════════════════════════
@@ -597,21 +2919,14 @@ def login_page():
             login_input = st.text_input("Nom d'utilisateur ou Email", key="login_user")
             login_pwd   = st.text_input("Mot de passe", type="password", key="login_pwd")
             if st.button("Se connecter", key="login_btn"):
-                hashed = hash_password(login_pwd)
-                matched = next(
-                    (u for u in st.session_state.users
-                     if (u.get('username') == login_input or u.get('email') == login_input)
-                     and u.get('password') == hashed), None)
+                user    = find_user(login_input)
+                matched = user if user and user.get('password') == hash_password(login_pwd) else None
                 if matched:
                     st.session_state.logged_in = True
                     st.session_state.user_type = 'buyer'
                     st.session_state.current_user = matched.get('username') or matched.get('email')
-                    anon_cart = st.session_state.get('cart', [])
                     user = st.session_state.current_user
-                    if anon_cart:
-                        st.session_state.user_carts.setdefault(user, []).extend(anon_cart)
-                        st.session_state.cart = []
-                        _persist_user_cart(user)
+                    merge_anon_cart(user)
                     st.session_state.show_client_auth = False
                     st.success(f"Bienvenue, {user} !")
                     st.rerun()
@@ -638,24 +2953,22 @@ def login_page():
             if st.button("S'inscrire", key="reg_btn"):
                 if not reg_username or not reg_email or not reg_pwd:
                     st.error("Veuillez remplir tous les champs.")
-                elif any(u['username'] == reg_username for u in st.session_state.users):
-                    st.error("Ce nom d'utilisateur existe déjà.")
+                elif find_user(reg_username) or find_user(reg_email):
+                    st.error("Ce nom d'utilisateur ou cet email existe déjà.")
                 else:
                     new_user = {
                         'username': reg_username, 'email': reg_email,
                         'password': hash_password(reg_pwd),
                         'created_at': str(datetime.now()), 'is_admin': False
                     }
-                    st.session_state.users.append(new_user)
-                    save_users(st.session_state.users)
+                    created = upsert_user(new_user, ignore_duplicates=True)
+                    if not created:
+                        st.error("Ce nom d'utilisateur ou cet email existe déjà.")
+                        return
                     st.session_state.logged_in = True
                     st.session_state.user_type = 'buyer'
                     st.session_state.current_user = reg_username
-                    anon_cart = st.session_state.get('cart', [])
-                    if anon_cart:
-                        st.session_state.user_carts.setdefault(reg_username, []).extend(anon_cart)
-                        st.session_state.cart = []
-                        _persist_user_cart(reg_username)
+                    merge_anon_cart(reg_username)
                     st.session_state.show_client_auth = False
                     st.success("Inscription réussie.")
                     st.rerun()
@@ -671,17 +2984,20 @@ def login_page():
                     st.error("Remplissez tous les champs.")
                 elif new_pwd != new_pwd2:
                     st.error("Les mots de passe ne correspondent pas.")
-                elif verify_reset_token(reset_email, reset_token):
-                    user = next((u for u in st.session_state.users
-                                 if u.get('email') == reset_email and u.get('reset_token') == reset_token), None)
-                    if user:
-                        user['password'] = hash_password(new_pwd)
-                        clear_reset_token_for_user(user)
-                        st.success("Mot de passe réinitialisé.")
-                    else:
-                        st.error("Utilisateur introuvable.")
                 else:
-                    st.error("Token invalide ou expiré.")
+                    user = verify_reset_token(reset_email, reset_token)
+                    if not user:
+                        st.error("Token invalide ou expiré.")
+                    elif update_user(user.get('username'), {'password': hash_password(new_pwd)}):
+                        clear_reset_token(reset_token)
+                        st.success("Mot de passe réinitialisé.")
+
+
+MARKET_PAGE_SIZE = 12
+
+
+def _select_market_category(name: str):
+    st.session_state.market_category = name
 
 
 def marketplace_page():
@@ -695,7 +3011,9 @@ def marketplace_page():
     recs        = []
     current_user = st.session_state.get('current_user')
     if current_user:
-        recs = recommend_for_user(current_user, limit=5)
+        recs = recommend_copurchases(current_user, limit=5)
+        if len(recs) < 5:
+            recs += [r for r in recommend_for_user(current_user, limit=5) if r not in recs][:5 - len(recs)]
     if not recs and purchases:
         recs = get_global_top_products(5)
 
@@ -706,107 +3024,123 @@ def marketplace_page():
                 with cols[i]:
                     st.write(rec)
                     if st.button("Voir", key=f"rec_{i}"):
-                        st.session_state.rec_query = rec
+                        st.session_state.market_search = rec
                         st.rerun()
 
     col1, col2 = st.columns([3, 1])
     with col1:
-        if 'rec_query' in st.session_state:
-            search_query = st.session_state.pop('rec_query')
-        else:
-            search_query = st.text_input("🔍 Rechercher produits, villes...", placeholder="Ex: pomme, Niamey")
+        search_query = st.text_input("🔍 Rechercher produits, villes...", placeholder="Ex: pomme, Niamey",
+                                     key="market_search")
     with col2:
         selected_category = st.selectbox(
             "📁 Catégorie",
-            ["Toutes"] + [cat_info["name"] for cat_info in CATEGORIES.values()]
+            ["Toutes"] + [cat_info["name"] for cat_info in CATEGORIES.values()],
+            key="market_category"
         )
 
     st.subheader("Catégories")
     category_cols = st.columns(len(CATEGORIES))
     for idx, (cat_id, cat_info) in enumerate(CATEGORIES.items()):
         with category_cols[idx]:
-            if st.button(cat_info["name"], use_container_width=True):
-                selected_category = cat_info["name"]
+            st.button(cat_info["name"], use_container_width=True,
+                      on_click=_select_market_category, args=(cat_info["name"],))
 
-    filtered_products = st.session_state.products
-    if search_query:
-        sq = search_query.lower()
-        filtered_products = [p for p in filtered_products
-                             if sq in p['produit'].lower() or sq in p.get('ville','').lower()]
+    cat_id = None
     if selected_category != "Toutes":
         cat_id = next((cid for cid, info in CATEGORIES.items() if info["name"] == selected_category), None)
-        if cat_id:
-            filtered_products = [p for p in filtered_products if p['categorie'] == cat_id]
 
-    if not filtered_products:
+    # Pagination : la page et les curseurs repartent de zéro quand les filtres changent
+    if st.session_state.get('market_filters') != (search_query, cat_id):
+        st.session_state.market_filters = (search_query, cat_id)
+        st.session_state.market_page    = 0
+        st.session_state.market_cursors = [None]
+    page    = st.session_state.market_page
+    cursors = st.session_state.market_cursors
+    version = shared_cache.version("products")
+    if search_query:
+        # recherche plein texte : index en mémoire (accents, classement), puis découpe en pages
+        hits          = search_catalog(search_query, cat_id)
+        start         = page * MARKET_PAGE_SIZE
+        page_products = hits[start:start + MARKET_PAGE_SIZE]
+        has_next      = len(hits) > start + MARKET_PAGE_SIZE
+        stats         = get_catalog_columns().stats_for_ids(p.get('id') for p in hits)
+    else:
+        try:
+            try:
+                rows  = fetch_products_page(cat_id, cursors[page], MARKET_PAGE_SIZE + 1, version)
+                stats = get_product_stats(cat_id, version)
+            except WritesPending:
+                rows  = storage.query_products(cat_id, cursors[page], MARKET_PAGE_SIZE + 1)
+                stats = storage.product_stats(cat_id)
+        except Exception as e:
+            st.warning(f"Erreur fetch_products_page: {e}")
+            rows, stats = [], {"count": 0, "avg_price": None, "cities": 0}
+        page_products = rows[:MARKET_PAGE_SIZE]
+        has_next      = len(rows) > MARKET_PAGE_SIZE
+        if has_next and len(cursors) == page + 1:
+            cursors.append(page_products[-1].get('id'))
+
+    if not page_products:
         st.warning("Aucun produit trouvé.")
     else:
-        df = pd.DataFrame(filtered_products)
-        df['emoji'] = df['produit'].apply(get_emoji)
+        card_cache = get_card_cache()
+        card_cache.sync(version)
+        cards = card_cache.cards(page_products)
         cols_per_row = 3
-        rows = [df.iloc[i:i+cols_per_row] for i in range(0, len(df), cols_per_row)]
-        for row in rows:
+        for row_start in range(0, len(cards), cols_per_row):
             cols = st.columns(cols_per_row)
-            for idx, (_, product) in enumerate(row.iterrows()):
-                with cols[idx]:
-                    emoji = product['emoji']
-                    st.markdown(f"""
-                    <div style='border:1px solid #ddd;border-radius:10px;padding:15px;
-                                margin-bottom:10px;background-color:white;'>
-                        <div style='font-size:40px;text-align:center;'>{emoji}</div>
-                        <h3 style='text-align:center;'>{product['produit']}</h3>
-                        <h2 style='color:#2E8B57;text-align:center;'>{product['prix']} FCFA</h2>
-                        <p style='text-align:center;'>
-                            📍 {product['ville']}<br>📅 {product['date']}<br>
-                            📁 {CATEGORIES[product['categorie']]['name']}<br>
-                            👤 Vendeur: {product.get('vendeur','—')}<br>
-                            📞 Contact: {product.get('contact','—')}<br>
-                            <a href="{contact_link(product.get('contact',''))}" target="_blank">
-                                Contacter le vendeur</a>
-                        </p>
-                    </div>""", unsafe_allow_html=True)
-
-                    unique_key = hashlib.sha1(
-                        f"{product.get('produit','')}-{product.get('vendeur','')}-"
-                        f"{product.get('ville','')}-{product.get('prix','')}-{product.get('date','')}".encode()
-                    ).hexdigest()[:10]
-
-                    if st.button("➕ Ajouter au panier", key=f"addcart_{unique_key}", use_container_width=True):
-                        add_to_cart_item({
-                            'produit': product['produit'], 'prix': product['prix'],
-                            'vendeur': product.get('vendeur','—'), 'contact': product.get('contact','—'),
-                            'categorie': product['categorie'], 'ville': product.get('ville','—'),
-                            'date': product.get('date','')
-                        })
-                        st.success(f"{product['produit']} ajouté au panier.")
+            for col, card in zip(cols, cards[row_start:row_start + cols_per_row]):
+                with col:
+                    st.markdown(card['html'], unsafe_allow_html=True)
+                    item = card['cart_item']
 
-                    if st.button("🛒 Acheter Maintenant", key=f"buy_{unique_key}", use_container_width=True):
+                    if st.button("➕ Ajouter au panier", key=f"addcart_{card['key']}", use_container_width=True):
+                        add_to_cart_item(dict(item))
+                        st.success(f"{card['produit']} ajouté au panier.")
+
+                    if st.button("🛒 Acheter Maintenant", key=f"buy_{card['key']}", use_container_width=True):
                         purchase = {
-                            "produit": product['produit'], "prix": product['prix'],
-                            "vendeur": product.get('vendeur','—'), "contact": product.get('contact','—'),
-                            "categorie": product['categorie'],
+                            "produit": item['produit'], "prix": item['prix'],
+                            "vendeur": item['vendeur'], "contact": item['contact'],
+                            "categorie": item['categorie'], "ville": item.get('ville'),
                             "date_achat": str(datetime.now()),
                             "acheteur": st.session_state.get('current_user','Anonyme')
                         }
-                        st.session_state.purchases.append(purchase)
-                        save_purchases(st.session_state.purchases)
-                        st.success(f"{product['produit']} acheté!")
+                        if record_purchases([purchase]):
+                            refresh_session_data()
+                            st.success(f"{card['produit']} acheté!")
+
+        col_prev, col_page, col_next = st.columns([1, 2, 1])
+        with col_prev:
+            if page > 0 and st.button("← Précédent", key="market_prev"):
+                st.session_state.market_page -= 1
+                st.rerun()
+        with col_page:
+            st.caption(f"Page {page + 1}")
+        with col_next:
+            if has_next and st.button("Suivant →", key="market_next"):
+                st.session_state.market_page += 1
+                st.rerun()
 
         st.markdown("---")
         st.subheader("📈 Statistiques du marché")
         col1, col2, col3 = st.columns(3)
-        with col1: st.metric("Produits disponibles", len(filtered_products))
-        with col2: st.metric("Prix moyen", f"{df['prix'].astype(float).mean():.0f} FCFA")
-        with col3: st.metric("Villes", df['ville'].nunique())
+        with col1: st.metric("Produits disponibles", stats['count'])
+        with col2: st.metric("Prix moyen", f"{float(stats['avg_price'] or 0):.0f} FCFA")
+        with col3: st.metric("Villes", stats['cities'])
 
 
 def seller_dashboard():
     st.header("👨‍💼 Tableau de Bord Vendeur")
+    catalog = get_catalog_columns()
     col1, col2, col3, col4 = st.columns(4)
-    with col1: st.metric("📦 Produits", len(st.session_state.products))
-    with col2: st.metric("💰 Chiffre",
-                          f"{sum(float(p['prix']) for p in st.session_state.products):.0f} FCFA")
-    with col3: st.metric("🏪 Ventes", "0")
+    with col1: st.metric("📦 Produits", catalog.count)
+    with col2: st.metric("💰 Chiffre", f"{catalog.price_sum:.0f} FCFA")
+    with col3:
+        try:
+            st.metric("🏪 Ventes", get_sales_totals(None, None, sales_version())['units'])
+        except Exception as e:
+            st.warning(f"Erreur get_sales_totals: {e}")
     with col4: st.metric("⭐ Rating", "4.8")
 
     st.subheader("Actions rapides")
@@ -863,32 +3197,32 @@ def add_product_page():
                     "date": str(date), "categorie": category_options[category_name],
                     "vendeur": vendeur, "contact": contact
                 }
-                st.session_state.products.append(new_product)
-                save_products()
-                st.success(f"Produit '{product_name}' ajouté!")
+                if insert_product(new_product):
+                    refresh_session_data()
+                    st.success(f"Produit '{product_name}' ajouté!")
 
 
 def my_products_page():
     st.subheader("📋 Mes produits")
     if st.session_state.products:
-        df = pd.DataFrame(st.session_state.products)
-        for idx, (_, p) in enumerate(df.iterrows()):
+        for p in st.session_state.products:
+            pid = p.get('id')
             col1, col2, col3 = st.columns([3, 1, 1])
             with col1: st.write(f"**{p['produit']}** - {p['prix']} FCFA - {p['ville']}")
             with col2:
-                if st.button("✏️ Éditer", key=f"edit_{idx}"):
-                    st.session_state.editing_product = idx
+                if st.button("✏️ Éditer", key=f"edit_{pid}"):
+                    st.session_state.editing_product = pid
             with col3:
-                if st.button("🗑️ Supprimer", key=f"delete_{idx}"):
-                    st.session_state.products.pop(idx)
-                    save_products()
+                if st.button("🗑️ Supprimer", key=f"delete_{pid}"):
+                    delete_product(pid)
                     st.rerun()
         st.markdown("---")
         st.subheader("Mes statistiques")
+        catalog = get_catalog_columns()
         col1, col2, col3 = st.columns(3)
-        with col1: st.metric("Valeur totale", f"{df['prix'].astype(float).sum():.0f} FCFA")
-        with col2: st.metric("Prix moyen",    f"{df['prix'].astype(float).mean():.0f} FCFA")
-        with col3: st.metric("Villes",         df['ville'].nunique())
+        with col1: st.metric("Valeur totale", f"{catalog.price_sum:.0f} FCFA")
+        with col2: st.metric("Prix moyen",    f"{float(catalog.price_mean or 0):.0f} FCFA")
+        with col3: st.metric("Villes",         catalog.n_cities)
     if st.button("← Retour"):
         st.session_state.show_my_products = False
         st.rerun()
@@ -897,35 +3231,141 @@ def my_products_page():
 def seller_stats_page():
     st.subheader("📈 Statistiques détaillées")
     if st.session_state.products:
-        df = pd.DataFrame(st.session_state.products)
-        df['prix'] = df['prix'].astype(float)
-        fig1 = px.pie(values=df['categorie'].value_counts().values,
-                      names=[CATEGORIES[c]['name'] for c in df['categorie'].value_counts().index],
+        catalog = get_catalog_columns()
+        fig1 = px.pie(values=catalog.category_counts.values,
+                      names=[CATEGORIES.get(c, {}).get('name', c) for c in catalog.category_counts.index],
                       color_discrete_sequence=px.colors.qualitative.Set3)
         st.plotly_chart(fig1, use_container_width=True)
-        fig2 = px.bar(df.groupby('ville')['prix'].mean().reset_index(),
+        fig2 = px.bar(catalog.mean_price_by_city.reset_index(),
                       x='ville', y='prix', title="Prix moyen par ville")
         st.plotly_chart(fig2, use_container_width=True)
-        st.dataframe(df, use_container_width=True)
+        st.dataframe(catalog.frame, use_container_width=True)
+
+    st.markdown("#### 🏪 Ventes des 30 derniers jours")
+    end   = datetime.now().date()
+    try:
+        sales = get_sales_rollup((end - timedelta(days=29)).isoformat(), end.isoformat(), sales_version())
+    except Exception as e:
+        st.warning(f"Erreur get_sales_rollup: {e}")
+    else:
+        if sales.empty:
+            st.info("Aucune vente sur la période.")
+        else:
+            daily = sales.groupby('jour', as_index=False)[['units', 'revenue']].sum()
+            st.plotly_chart(px.bar(daily, x='jour', y='units', title="Unités vendues par jour"),
+                            use_container_width=True)
+            by_city = sales.groupby('ville', as_index=False)['revenue'].sum()
+            st.plotly_chart(px.bar(by_city, x='ville', y='revenue', title="Chiffre d'affaires par ville (FCFA)"),
+                            use_container_width=True)
     if st.button("← Retour"):
         st.session_state.show_stats = False
         st.rerun()
 
 
+# ── Grilles d'administration ─────────────────────────────────
+ADMIN_PAGE_SIZE = 25
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=128, show_spinner=False)
+def fetch_admin_page(table, columns, sort, descending, filters, search, search_columns, offset, limit, stamp):
+    """Une page triée / filtrée par la base ; `stamp` (voir SharedTableCache.stamp) sert de clé de cache."""
+    settle_writes(table)
+    return storage.query_table(table, columns, sort, descending, dict(filters),
+                               search, search_columns, offset, limit)
+
+
+def admin_grid(table: str, columns: tuple, search_columns: tuple = (), filter_column: str = None,
+               filter_labels: dict = None, key: str = None, row_actions=None) -> list:
+    """Grille paginée : tri, filtre et recherche exécutés par la base, une page de lignes à la fois.
+
+    row_actions(row) n'est appelé que pour les lignes de la page affichée ; renvoie ces lignes.
+    """
+    key = key or table
+    c1, c2, c3, c4, c5 = st.columns([3, 2, 2, 1, 2])
+    with c1:
+        search = st.text_input("🔍 Rechercher", key=f"grid_{key}_search").strip()
+    with c2:
+        search_in = st.selectbox("Dans", ["toutes"] + list(search_columns), key=f"grid_{key}_search_in")
+    with c3:
+        sort = st.selectbox("Trier par", columns, key=f"grid_{key}_sort")
+    with c4:
+        descending = st.checkbox("↓", key=f"grid_{key}_desc")
+    filters = ()
+    with c5:
+        if filter_column:
+            choice = st.selectbox(filter_column.capitalize(), [None] + list(filter_labels or {}),
+                                  format_func=lambda v: "Tous" if v is None else filter_labels.get(v, v),
+                                  key=f"grid_{key}_filter")
+            if choice is not None:
+                filters = ((filter_column, choice),)
+
+    # nouvelle requête -> retour à la première page
+    page_key = f"grid_{key}_page"
+    query    = (search, search_in, sort, descending, filters)
+    if st.session_state.get(f"grid_{key}_query") != query:
+        st.session_state[f"grid_{key}_query"] = query
+        st.session_state[page_key] = 0
+    page = st.session_state.get(page_key, 0)
+
+    targets = tuple(search_columns) if search_in == "toutes" else (search_in,)
+    try:
+        try:
+            rows, total = fetch_admin_page(table, tuple(columns), sort, descending, filters, search or None,
+                                           targets, page * ADMIN_PAGE_SIZE, ADMIN_PAGE_SIZE, shared_cache.stamp(table))
+        except WritesPending:
+            rows, total = storage.query_table(table, tuple(columns), sort, descending, dict(filters), search or None,
+                                              targets, page * ADMIN_PAGE_SIZE, ADMIN_PAGE_SIZE)
+    except Exception as e:
+        st.warning(f"Erreur fetch_admin_page: {e}")
+        return []
+    if not total:
+        st.info("Aucune ligne.")
+        return []
+    st.dataframe(pd.DataFrame.from_records(rows, columns=list(columns)), hide_index=True, use_container_width=True)
+
+    pages = -(-total // ADMIN_PAGE_SIZE)
+    col_prev, col_page, col_next = st.columns([1, 2, 1])
+    with col_prev:
+        if page > 0 and st.button("← Précédent", key=f"grid_{key}_prev"):
+            st.session_state[page_key] = page - 1
+            st.rerun()
+    with col_page:
+        st.caption(f"Page {page + 1}/{pages} — {total} lignes")
+    with col_next:
+        if page + 1 < pages and st.button("Suivant →", key=f"grid_{key}_next"):
+            st.session_state[page_key] = page + 1
+            st.rerun()
+
+    if row_actions:
+        for row in rows:
+            row_actions(row)
+    return rows
+
+
+def _admin_product_actions(prod: dict):
+    pid  = prod.get('id')
+    cols = st.columns([3, 1, 1])
+    with cols[0]:
+        st.write(f"{prod.get('produit','—')} — {prod.get('prix','—')} FCFA — {prod.get('ville','—')}")
+        st.write(f"Vendeur: {prod.get('vendeur','—')} — Contact: {prod.get('contact','—')}")
+    with cols[1]:
+        if st.button("✏️ Éditer", key=f"admin_edit_{pid}"):
+            st.session_state.admin_edit_id = pid
+            st.session_state.admin_edit_row = prod
+    with cols[2]:
+        if st.button("🗑️ Supprimer", key=f"admin_delete_{pid}"):
+            delete_product(pid)
+            st.rerun()
+
+
 def admin_dashboard():
     st.header("🔐 Tableau d'administration")
     tabs = st.tabs(["Utilisateurs", "Produits", "Statistiques"])
 
     with tabs[0]:
         st.subheader("Utilisateurs enregistrés")
-        users = st.session_state.get('users', [])
-        if not users:
-            st.info("Aucun utilisateur.")
-        else:
-            df = pd.DataFrame(users)
-            if 'password' in df.columns:
-                df = df.drop(columns=['password'])
-            st.dataframe(df, use_container_width=True)
+        admin_grid("users", ("id", "username", "email", "created_at", "is_admin"),
+                   search_columns=("username", "email"))
 
     with tabs[1]:
         st.subheader("Gérer les produits")
@@ -945,127 +3385,120 @@ def admin_dashboard():
                         "date": str(p_date), "categorie": category_options[p_cat_n],
                         "vendeur": p_vendeur, "contact": p_contact
                     }
-                    st.session_state.products.append(new_product)
-                    save_products()
-                    st.success("Produit ajouté.")
+                    if insert_product(new_product):
+                        refresh_session_data()
+                        st.success("Produit ajouté.")
 
         st.markdown("---")
-        if not st.session_state.products:
-            st.info("Aucun produit.")
-        else:
-            st.dataframe(pd.DataFrame(st.session_state.products), use_container_width=True)
-            for idx, prod in enumerate(st.session_state.products):
-                cols = st.columns([3, 1, 1])
-                with cols[0]:
-                    st.write(f"{prod.get('produit','—')} — {prod.get('prix','—')} FCFA — {prod.get('ville','—')}")
-                    st.write(f"Vendeur: {prod.get('vendeur','—')} — Contact: {prod.get('contact','—')}")
-                with cols[1]:
-                    if st.button("✏️ Éditer", key=f"admin_edit_{idx}"):
-                        st.session_state.admin_edit_index = idx
-                with cols[2]:
-                    if st.button("🗑️ Supprimer", key=f"admin_delete_{idx}"):
-                        st.session_state.products.pop(idx)
-                        save_products()
-                        st.rerun()
-
-            if 'admin_edit_index' in st.session_state:
-                i = st.session_state.admin_edit_index
-                if 0 <= i < len(st.session_state.products):
-                    prod = st.session_state.products[i]
-                    st.markdown("---")
-                    st.subheader(f"Éditer: {prod.get('produit')}")
-                    cat_names = list(category_options.keys())
-                    prod_cat_id   = prod.get('categorie')
-                    prod_cat_name = CATEGORIES.get(prod_cat_id, {}).get('name')
-                    default_idx   = cat_names.index(prod_cat_name) if prod_cat_name in cat_names else 0
-                    try:
-                        default_price = float(prod.get('prix', 0))
-                    except Exception:
-                        default_price = 0.0
-                    try:
-                        default_date = datetime.fromisoformat(prod.get('date')) if prod.get('date') else datetime.now()
-                    except Exception:
-                        default_date = datetime.now()
-                    with st.form("admin_edit_form"):
-                        e_name    = st.text_input("Nom",     value=prod.get('produit',''))
-                        e_city    = st.text_input("Ville",   value=prod.get('ville',''))
-                        e_price   = st.number_input("Prix",  value=default_price, step=100.0)
-                        e_date    = st.date_input("Date",    value=default_date)
-                        e_cat     = st.selectbox("Catégorie", cat_names, index=default_idx)
-                        e_vendeur = st.text_input("Vendeur", value=prod.get('vendeur',''))
-                        e_contact = st.text_input("Contact", value=prod.get('contact',''))
-                        col_c, col_s = st.columns([1, 2])
-                        with col_c:
-                            if st.form_submit_button("Annuler"):
-                                del st.session_state['admin_edit_index']
-                                st.rerun()
-                        with col_s:
-                            if st.form_submit_button("Enregistrer"):
-                                prod.update({
-                                    'produit': e_name, 'ville': e_city, 'prix': str(int(e_price)),
-                                    'date': str(e_date),
-                                    'categorie': next(
-                                        (cid for cid, info in CATEGORIES.items() if info['name'] == e_cat),
-                                        prod.get('categorie')),
-                                    'vendeur': e_vendeur, 'contact': e_contact
-                                })
-                                save_products()
-                                del st.session_state['admin_edit_index']
-                                st.success("Produit mis à jour.")
-                                st.rerun()
+        admin_grid("products", tuple(PRODUCT_COLUMNS), search_columns=("produit", "ville", "vendeur", "contact"),
+                   filter_column="categorie", filter_labels={cid: info["name"] for cid, info in CATEGORIES.items()},
+                   row_actions=_admin_product_actions)
+
+        if 'admin_edit_id' in st.session_state:
+            prod = st.session_state.get('admin_edit_row')
+            if prod:
+                st.markdown("---")
+                st.subheader(f"Éditer: {prod.get('produit')}")
+                cat_names = list(category_options.keys())
+                prod_cat_id   = prod.get('categorie')
+                prod_cat_name = CATEGORIES.get(prod_cat_id, {}).get('name')
+                default_idx   = cat_names.index(prod_cat_name) if prod_cat_name in cat_names else 0
+                try:
+                    default_price = float(prod.get('prix', 0))
+                except Exception:
+                    default_price = 0.0
+                try:
+                    default_date = datetime.fromisoformat(prod.get('date')) if prod.get('date') else datetime.now()
+                except Exception:
+                    default_date = datetime.now()
+                with st.form("admin_edit_form"):
+                    e_name    = st.text_input("Nom",     value=prod.get('produit',''))
+                    e_city    = st.text_input("Ville",   value=prod.get('ville',''))
+                    e_price   = st.number_input("Prix",  value=default_price, step=100.0)
+                    e_date    = st.date_input("Date",    value=default_date)
+                    e_cat     = st.selectbox("Catégorie", cat_names, index=default_idx)
+                    e_vendeur = st.text_input("Vendeur", value=prod.get('vendeur',''))
+                    e_contact = st.text_input("Contact", value=prod.get('contact',''))
+                    col_c, col_s = st.columns([1, 2])
+                    with col_c:
+                        if st.form_submit_button("Annuler"):
+                            del st.session_state['admin_edit_id']
+                            st.rerun()
+                    with col_s:
+                        if st.form_submit_button("Enregistrer"):
+                            edited = {
+                                'produit': e_name, 'ville': e_city, 'prix': str(int(e_price)),
+                                'date': str(e_date),
+                                'categorie': next(
+                                    (cid for cid, info in CATEGORIES.items() if info['name'] == e_cat),
+                                    prod.get('categorie')),
+                                'vendeur': e_vendeur, 'contact': e_contact
+                            }
+                            changed = {k: v for k, v in edited.items() if prod.get(k) != v}
+                            update_product(prod.get('id'), changed)
+                            del st.session_state['admin_edit_id']
+                            st.success("Produit mis à jour.")
+                            st.rerun()
 
     with tabs[2]:
         admin_stats_tab()
 
 
-def get_month_purchases(purchases, month_offset=0):
-    from datetime import date
-    today  = date.today()
-    tm     = today.month + month_offset
-    ty     = today.year
-    if tm <= 0:
-        tm += 12; ty -= 1
-    elif tm > 12:
-        tm -= 12; ty += 1
-    result = []
-    for p in purchases:
-        try:
-            d = datetime.fromisoformat(p.get('date_achat', '')).date()
-            if d.month == tm and d.year == ty:
-                result.append(p)
-        except Exception:
-            pass
-    return result
-
-
 def admin_stats_tab():
     st.subheader("📊 Statistiques des achats")
-    purchases = st.session_state.get('purchases', [])
-    if not purchases:
+    with st.expander("♻️ Restaurer les achats depuis une sauvegarde"):
+        st.warning("Cette opération remplace TOUS les achats enregistrés.")
+        backup = st.file_uploader("Fichier JSON (ex: backups/purchases.json.backup)", key="restore_purchases_file")
+        if backup is not None and st.button("Restaurer", key="restore_purchases_btn"):
+            try:
+                restored = json.load(backup)
+            except Exception:
+                st.error("Fichier JSON invalide.")
+            else:
+                restore_purchases(restored)
+                st.success(f"{len(restored)} achats restaurés.")
+                st.rerun()
+    with st.expander("🔁 Recalculer les agrégats de ventes"):
+        st.caption("Reconstruit la table sales_daily à partir de tous les achats (backfill).")
+        if st.button("Recalculer", key="rebuild_sales_btn") and rebuild_sales_rollup():
+            st.success("Agrégats de ventes recalculés.")
+    # une lecture d'agrégats en échec ne doit pas masquer la liste des achats
+    try:
+        admin_sales_summary(sales_version())
+    except Exception as e:
+        st.warning(f"Erreur admin_sales_summary: {e}")
+
+    st.markdown("---")
+    st.subheader("Liste des achats")
+    admin_grid("purchases", TABLE_COLUMNS["purchases"], search_columns=("produit", "acheteur", "vendeur", "ville"),
+               filter_column="categorie", filter_labels={cid: info["name"] for cid, info in CATEGORIES.items()})
+
+
+def admin_sales_summary(version: int):
+    """Totaux d'achats et top produits par catégorie, lus dans sales_daily."""
+    totals = get_sales_totals(None, None, version)
+    if not totals['units']:
         st.info("Aucun achat enregistré.")
         return
-    curr  = get_month_purchases(purchases, 0)
-    prev  = get_month_purchases(purchases, -1)
-    col1, col2, col3 = st.columns(3)
-    with col1: st.metric("Total achats",         len(purchases))
-    with col2: st.metric("Achats ce mois",        len(curr))
-    with col3: st.metric("Achats mois précédent", len(prev))
+    today      = datetime.now().date()
+    last_month = today.replace(day=1) - timedelta(days=1)
+    months     = purchases_between(last_month, today, 'month')
+    prev, curr = months.iloc[0], months.iloc[-1]
+    col1, col2, col3, col4 = st.columns(4)
+    with col1: st.metric("Total achats",         totals['units'])
+    with col2: st.metric("Achats ce mois",        int(curr['units']))
+    with col3: st.metric("Achats mois précédent", int(prev['units']))
+    with col4: st.metric("CA ce mois",            f"{curr['revenue']:.0f} FCFA")
 
     st.markdown("---")
     st.subheader("Produits les plus achetés par catégorie")
-    from collections import Counter
-    cat_stats = {}
-    for p in purchases:
-        cat  = p.get('categorie','inconnu')
-        prod = p.get('produit','inconnu')
-        cat_stats.setdefault(cat, Counter())[prod] += 1
-
+    cat_stats = get_top_products_by_category(5, version)
     valid_cats = [c for c in cat_stats if c in CATEGORIES]
     if valid_cats:
         cat_tabs = st.tabs([CATEGORIES[c]['name'] for c in valid_cats])
         for tab, cat in zip(cat_tabs, valid_cats):
             with tab:
-                top = cat_stats[cat].most_common(5)
+                top = cat_stats[cat]
                 for prod, count in top:
                     st.write(f"**{prod}**: {count} achats")
                 if top:
@@ -1074,15 +3507,14 @@ def admin_stats_tab():
                                  title=f"Top produits — {CATEGORIES[cat]['name']}")
                     st.plotly_chart(fig, use_container_width=True)
 
-    st.markdown("---")
-    st.subheader("Liste complète des achats")
-    st.dataframe(pd.DataFrame(purchases), use_container_width=True)
-
 
 def cart_page():
     st.header("🧾 Mon Panier")
     current_user = st.session_state.get('current_user')
-    cart = st.session_state.user_carts.get(current_user, []) if current_user else st.session_state.get('cart', [])
+    cart = get_active_cart()
+    last_order = st.session_state.pop('last_order_id', None)
+    if last_order is not None:
+        st.success(f"Paiement simulé réussi — commande n°{last_order}.")
 
     if not cart:
         if current_user:
@@ -1108,6 +3540,7 @@ def cart_page():
                     prod = next((p for p in products_list if p.get('produit') == sel), None)
                     if prod:
                         add_to_cart_item({
+                            'product_id': prod.get('id'),
                             'produit': prod.get('produit'), 'prix': prod.get('prix'),
                             'vendeur': prod.get('vendeur','—'), 'contact': prod.get('contact','—'),
                             'categorie': prod.get('categorie'), 'ville': prod.get('ville','—'),
@@ -1117,7 +3550,7 @@ def cart_page():
                         st.rerun()
 
     total = 0.0
-    for i, item in enumerate(list(cart)):
+    for key, item in list(cart.items()):
         cols = st.columns([3, 1, 1])
         with cols[0]:
             st.write(f"**{item.get('produit')}** — {item.get('vendeur','—')}")
@@ -1129,13 +3562,11 @@ def cart_page():
                 price_val = 0.0
             st.write(f"{price_val:.0f} FCFA")
         with cols[2]:
-            qty_key = f"qty_{'user' if current_user else 'anon'}_{i}"
+            qty_key = f"qty_{'user' if current_user else 'anon'}_{key}"
             current_qty = int(item.get('quantity', 1)) if item.get('quantity') else 1
             new_qty = st.number_input("Qté", min_value=1, value=current_qty, key=qty_key)
-            if new_qty != current_qty and st.button("Mettre à jour", key=f"update_qty_{i}"):
-                item['quantity'] = int(new_qty)
-                if current_user:
-                    _persist_user_cart(current_user)
+            if new_qty != current_qty and st.button("Mettre à jour", key=f"update_qty_{key}"):
+                set_cart_quantity(key, new_qty)
                 st.success("Quantité mise à jour.")
                 st.rerun()
         try:
@@ -1146,11 +3577,7 @@ def cart_page():
     col1, col2 = st.columns([2, 1])
     with col1:
         if st.button("Vider le panier"):
-            if current_user:
-                st.session_state.user_carts[current_user] = []
-                supabase.table("carts").delete().eq("username", current_user).execute()
-            else:
-                st.session_state.cart = []
+            clear_cart()
             st.success("Panier vidé.")
             st.rerun()
     with col2:
@@ -1158,42 +3585,36 @@ def cart_page():
 
     st.markdown("---")
     st.subheader("Gérer les articles")
-    for i, item in enumerate(list(cart)):
+    for key, item in list(cart.items()):
         cols = st.columns([3, 1])
         with cols[0]:
             st.write(f"**{item.get('produit')}** — {item.get('prix')} FCFA — {item.get('vendeur')}")
         with cols[1]:
-            if st.button("Supprimer", key=f"remove_{i}"):
-                if current_user:
-                    st.session_state.user_carts[current_user].pop(i)
-                    _persist_user_cart(current_user)
-                else:
-                    try:
-                        st.session_state.cart.pop(i)
-                    except Exception:
-                        pass
+            if st.button("Supprimer", key=f"remove_{key}"):
+                remove_cart_line(key)
                 st.success("Article supprimé.")
                 st.rerun()
 
     st.markdown("---")
     if st.button("Passer au paiement (simulation)"):
-        buyer       = st.session_state.get('current_user', 'Anonyme')
-        source_cart = (st.session_state.user_carts.get(current_user, [])
-                       if current_user else st.session_state.get('cart', []))
-        for item in list(source_cart):
-            st.session_state.purchases.append({
-                'produit': item.get('produit'), 'prix': item.get('prix'),
-                'vendeur': item.get('vendeur'), 'contact': item.get('contact'),
-                'categorie': item.get('categorie'),
-                'date_achat': str(datetime.now()), 'acheteur': buyer
-            })
-        save_purchases(st.session_state.purchases)
-        if current_user:
-            st.session_state.user_carts[current_user] = []
-            supabase.table("carts").delete().eq("username", current_user).execute()
-        else:
-            st.session_state.cart = []
-        st.success("Paiement simulé réussi.")
+        buyer       = current_user or 'Anonyme'
+        source_cart = get_active_cart().values()
+        new_purchases = [{
+            'produit': item.get('produit'), 'prix': item.get('prix'),
+            'vendeur': item.get('vendeur'), 'contact': item.get('contact'),
+            'categorie': item.get('categorie'), 'ville': item.get('ville'),
+            'date_achat': str(datetime.now()), 'acheteur': buyer
+        } for item in source_cart]
+        # même panier + même jeton = même clé : un nouvel essai renvoie la même commande,
+        # un panier modifié entre-temps en passe une nouvelle
+        nonce = st.session_state.setdefault('checkout_nonce', secrets.token_hex(16))
+        order = checkout_order(current_user, new_purchases, checkout_key(nonce, get_active_cart()))
+        if not order:
+            st.error("Le paiement n'a pas pu être enregistré.")
+            return
+        del st.session_state['checkout_nonce']
+        clear_cart(persist=False)
+        st.session_state.last_order_id = order['order_id']
         st.rerun()
 
 
@@ -1203,8 +3624,8 @@ def profile_page():
     if not current:
         st.info("Aucun utilisateur connecté.")
         return
-    user = next((u for u in st.session_state.get('users', []) if u.get('username') == current), None)
-    if not user:
+    user = find_user(current)
+    if not user or user.get('username') != current:
         st.error("Utilisateur introuvable.")
         return
     safe_user = {k: v for k, v in user.items() if k != 'password' and not k.startswith('reset_')}
@@ -1218,10 +3639,9 @@ def profile_page():
     with st.form("update_profile_form"):
         new_email = st.text_input("Email", value=safe_user.get('email',''))
         if st.form_submit_button("Mettre à jour"):
-            user['email'] = new_email
-            save_users(st.session_state.get('users', []))
-            st.success("Profil mis à jour.")
-            st.rerun()
+            if update_user(current, {'email': new_email}):
+                st.success("Profil mis à jour.")
+                st.rerun()
 
 
 # ═══════════════════════════════════════════════════════════════
@@ -1237,7 +3657,7 @@ with st.sidebar:
             if st.button("🛍️ Marketplace", use_container_width=True):
                 st.session_state.page = "marketplace"; st.rerun()
             cu = st.session_state.get('current_user')
-            count = len(st.session_state.user_carts.get(cu, [])) if cu else len(st.session_state.get('cart', []))
+            count = len(get_active_cart())
             cart_label = "📋 Mon Panier" + (f" ({count})" if count else "")
             if st.button(cart_label, use_container_width=True):
                 st.session_state.page = "cart"; st.rerun()
@@ -1247,8 +3667,14 @@ with st.sidebar:
             if st.button("👨‍💻 Tableau Admin", use_container_width=True):
                 st.session_state.page = "admin"; st.rerun()
         st.markdown("---")
+        pending_writes = write_queue.pending
+        if write_queue.last_error:
+            detail = f" ({write_queue.last_error})" if st.session_state.user_type == "admin" else ""
+            st.warning(f"⏳ {pending_writes} enregistrement(s) en attente, nouvel essai automatique{detail}.")
+        elif pending_writes:
+            st.caption(f"⏳ {pending_writes} enregistrement(s) en cours")
         if st.button("🚪 Déconnexion", use_container_width=True, type="secondary"):
-            preserve = ['logged_in','user_type','products','users','current_user']
+            preserve = ['logged_in','user_type','products','current_user']
             st.session_state.logged_in = False
             st.session_state.user_type = None
             st.session_state.current_user = None
@@ -1282,17 +3708,30 @@ else:
 # ═══════════════════════════════════════════════════════════════
 #
 # -- Table users
+# -- username / email uniques : leurs index servent aussi la connexion (find_user)
 # create table if not exists users (
 #   id           bigint generated always as identity primary key,
 #   username     text unique not null,
 #   email        text unique not null,
 #   password     text not null,
 #   created_at   text,
-#   reset_token  text,
-#   reset_expires text,
 #   is_admin     boolean default false
 # );
 #
+# -- Table password_resets (tokens de réinitialisation, 1 h de validité)
+# create table if not exists password_resets (
+#   token      text primary key,
+#   username   text not null references users(username) on delete cascade,
+#   expires_at text not null
+# );
+# create index if not exists password_resets_expires_idx on password_resets (expires_at);
+#
+# -- Table app_meta (drapeaux persistés, ex: json_migrated)
+# create table if not exists app_meta (
+#   key   text primary key,
+#   value text
+# );
+#
 # -- Table products
 # create table if not exists products (
 #   id        bigint generated always as identity primary key,
@@ -1304,6 +3743,27 @@ else:
 #   vendeur   text,
 #   contact   text
 # );
+# create index if not exists products_categorie_idx on products (categorie);
+#
+# -- Agrégats de la marketplace (nombre, prix moyen, villes), appelés via rpc("product_stats")
+# create or replace function product_stats(p_categorie text default null)
+# returns table (count bigint, avg_price numeric, cities bigint)
+# language sql stable as $$
+#   select count(*),
+#          avg(case when prix ~ '^[0-9]+(\.[0-9]+)?$' then prix::numeric end),
+#          count(distinct ville)
+#   from products
+#   where p_categorie is null or categorie = p_categorie;
+# $$;
+#
+# -- Commandes : une ligne par paiement, la clé d'idempotence empêche les doublons (double clic, rejeu)
+# create table if not exists orders (
+#   id              bigint generated always as identity primary key,
+#   idempotency_key text unique not null,
+#   acheteur        text,
+#   created_at      timestamptz default now(),
+#   lines           int
+# );
 #
 # -- Table purchases
 # create table if not exists purchases (
@@ -1313,21 +3773,182 @@ else:
 #   vendeur    text,
 #   contact    text,
 #   categorie  text,
+#   ville      text,
 #   date_achat text,
-#   acheteur   text
+#   acheteur   text,
+#   order_id   bigint references orders (id)
 # );
+# -- base existante : alter table purchases add column if not exists ville text;
+# --                  alter table purchases add column if not exists order_id bigint references orders (id);
+# create index if not exists purchases_order_idx on purchases (order_id);
 #
-# -- Table carts
+# -- Checkout atomique en un aller-retour, appelé via rpc("checkout") :
+# -- commande + achats + suppression du panier dans la même transaction
+# create or replace function checkout(p_username text, p_purchases jsonb, p_key text)
+# returns jsonb
+# language plpgsql as $$
+# declare
+#   v_order bigint;
+#   v_rows  jsonb;
+# begin
+#   insert into orders (idempotency_key, acheteur, lines)
+#   values (p_key, p_username, jsonb_array_length(p_purchases))
+#   on conflict (idempotency_key) do nothing
+#   returning id into v_order;
+#   if v_order is null then
+#     select id into v_order from orders where idempotency_key = p_key;
+#     select coalesce(jsonb_agg(to_jsonb(p) order by p.id), '[]') into v_rows
+#     from purchases p where p.order_id = v_order;
+#     if p_username is not null then
+#       delete from carts where username = p_username;
+#     end if;
+#     return jsonb_build_object('order_id', v_order, 'purchases', v_rows, 'replayed', true);
+#   end if;
+#   with inserted as (
+#     insert into purchases (produit, prix, vendeur, contact, categorie, ville, date_achat, acheteur, order_id)
+#     select produit, prix, vendeur, contact, categorie, ville, date_achat, acheteur, v_order
+#     from jsonb_populate_recordset(null::purchases, p_purchases)
+#     returning *
+#   )
+#   select coalesce(jsonb_agg(to_jsonb(inserted)), '[]') into v_rows from inserted;
+#   if p_username is not null then
+#     delete from carts where username = p_username;
+#   end if;
+#   return jsonb_build_object('order_id', v_order, 'purchases', v_rows, 'replayed', false);
+# end $$;
+#
+# -- Agrégats journaliers des ventes, une ligne d'achat = une unité ; tenus à jour par trigger.
+# -- Backfill / reconstruction : select rebuild_sales_daily();  (ou bouton de l'onglet statistiques admin)
+# create table if not exists sales_daily (
+#   jour      text not null,
+#   produit   text not null default '',
+#   categorie text not null default '',
+#   ville     text not null default '',
+#   vendeur   text not null default '',
+#   units     bigint not null default 0,
+#   revenue   numeric not null default 0,
+#   primary key (jour, produit, categorie, ville, vendeur)
+# );
+# create or replace function sales_daily_on_purchase() returns trigger
+# language plpgsql as $$
+# begin
+#   insert into sales_daily (jour, produit, categorie, ville, vendeur, units, revenue)
+#   values (coalesce(left(new.date_achat, 10), ''), coalesce(new.produit, ''), coalesce(new.categorie, ''),
+#           coalesce(new.ville, ''), coalesce(new.vendeur, ''), 1,
+#           case when new.prix ~ '^[0-9]+(\.[0-9]+)?$' then new.prix::numeric else 0 end)
+#   on conflict (jour, produit, categorie, ville, vendeur) do update
+#     set units   = sales_daily.units + excluded.units,
+#         revenue = sales_daily.revenue + excluded.revenue;
+#   return new;
+# end $$;
+# create or replace trigger purchases_sales_daily after insert on purchases
+#   for each row execute function sales_daily_on_purchase();
+#
+# create or replace function rebuild_sales_daily() returns void
+# language sql as $$
+#   delete from sales_daily where true;
+#   insert into sales_daily (jour, produit, categorie, ville, vendeur, units, revenue)
+#   select coalesce(left(date_achat, 10), ''), coalesce(produit, ''), coalesce(categorie, ''),
+#          coalesce(ville, ''), coalesce(vendeur, ''), count(*),
+#          sum(case when prix ~ '^[0-9]+(\.[0-9]+)?$' then prix::numeric else 0 end)
+#   from purchases group by 1, 2, 3, 4, 5;
+# $$;
+#
+# -- Totaux sur une période (bornes incluses, null = sans borne), appelés via rpc("sales_totals")
+# create or replace function sales_totals(p_start text default null, p_end text default null)
+# returns table (units bigint, revenue numeric)
+# language sql stable as $$
+#   select coalesce(sum(units), 0)::bigint, coalesce(sum(revenue), 0)
+#   from sales_daily
+#   where (p_start is null or jour >= p_start) and (p_end is null or jour <= p_end);
+# $$;
+#
+# -- Top produits achetés par catégorie (onglet statistiques admin), appelé via rpc("top_products_by_category")
+# create or replace function top_products_by_category(p_limit int default 5)
+# returns table (categorie text, produit text, achats bigint)
+# language sql stable as $$
+#   select categorie, produit, achats from (
+#     select categorie, produit, sum(units)::bigint as achats,
+#            row_number() over (partition by categorie order by sum(units) desc, produit) as rang
+#     from sales_daily group by categorie, produit
+#   ) t
+#   where rang <= p_limit
+#   order by categorie, rang;
+# $$;
+#
+# -- Flux de changements entre sessions / processus : chaque écriture sur products / purchases
+# -- ajoute une ligne à data_changes (deleted = pierre tombale) et avance data_versions.version.
+# -- Le verrou pris sur la ligne data_versions avant d'allouer le seq sérialise les écrivains
+# -- d'une table : un seq n'est visible qu'une fois tous les seq précédents validés.
+# create table if not exists data_changes (
+#   seq        bigint generated always as identity primary key,
+#   tbl        text not null,
+#   row_id     bigint not null,
+#   deleted    boolean not null default false,
+#   changed_at timestamptz not null default now()
+# );
+# create index if not exists data_changes_tbl_idx on data_changes (tbl, seq);
+# create table if not exists data_versions (
+#   tbl     text primary key,
+#   version bigint not null default 0
+# );
+# insert into data_versions (tbl) values ('products'), ('purchases') on conflict do nothing;
+#
+# create or replace function track_data_change() returns trigger
+# language plpgsql as $$
+# declare
+#   v_seq bigint;
+# begin
+#   perform 1 from data_versions where tbl = TG_TABLE_NAME for update;
+#   insert into data_changes (tbl, row_id, deleted)
+#   values (TG_TABLE_NAME, case when TG_OP = 'DELETE' then old.id else new.id end, TG_OP = 'DELETE')
+#   returning seq into v_seq;
+#   update data_versions set version = v_seq where tbl = TG_TABLE_NAME;
+#   return null;
+# end $$;
+# create or replace trigger products_changes after insert or update or delete on products
+#   for each row execute function track_data_change();
+# create or replace trigger purchases_changes after insert or update or delete on purchases
+#   for each row execute function track_data_change();
+#
+# -- Purge du journal (appelée au plus une fois par heure) ; changes_floor force un rechargement
+# -- complet des caches dont le curseur est antérieur à la purge
+# create or replace function prune_data_changes(p_hours numeric) returns void
+# language plpgsql as $$
+# declare
+#   v_floor bigint;
+# begin
+#   select max(seq) into v_floor from data_changes
+#   where changed_at < now() - make_interval(secs => p_hours * 3600);
+#   if v_floor is not null then
+#     delete from data_changes where seq <= v_floor;
+#     insert into app_meta (key, value) values ('changes_floor', v_floor::text)
+#     on conflict (key) do update set value = excluded.value;
+#   end if;
+# end $$;
+#
+# -- Table carts (une ligne par (username, line_key) ; line_key = "<id produit>|<vendeur>")
 # create table if not exists carts (
-#   id        bigint generated always as identity primary key,
-#   username  text not null,
-#   produit   text not null,
-#   prix      text,
-#   vendeur   text,
-#   contact   text,
-#   categorie text,
-#   ville     text,
-#   date      text,
-#   quantity  integer default 1
+#   id         bigint generated always as identity primary key,
+#   username   text not null,
+#   line_key   text not null,
+#   product_id bigint,
+#   produit    text not null,
+#   prix       text,
+#   vendeur    text,
+#   contact    text,
+#   categorie  text,
+#   ville      text,
+#   date       text,
+#   quantity   integer default 1,
+#   unique (username, line_key)
 # );
+# -- Base existante :
+# -- alter table carts add column if not exists product_id bigint;
+# -- alter table carts add column if not exists line_key text;
+# -- update carts set line_key = coalesce(product_id::text, produit) || '|' || coalesce(vendeur, '—');
+# -- delete from carts a using carts b
+# --   where a.username = b.username and a.line_key = b.line_key and a.id < b.id;
+# -- alter table carts alter column line_key set not null;
+# -- alter table carts add constraint carts_username_line_key_key unique (username, line_key);
 
@@ -0,0 +1,24 @@
+"""Les tests importent app.py sans serveur Streamlit (mode « bare »), sur le moteur SQLite hors ligne."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="kassua-tests-")
+os.environ["KASSUA_STORAGE"]       = "sqlite"
+os.environ["KASSUA_DB_PATH"]       = os.path.join(_TMP, "kassua.db")
+os.environ["KASSUA_WRITE_JOURNAL"] = os.path.join(_TMP, "kassua_writes.jsonl")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app():
+    import app as module
+    return module
+
+
+@pytest.fixture
+def store(app, tmp_path):
+    """Base SQLite neuve par test."""
+    return app.SQLiteStorage(str(tmp_path / "test.db"))
@@ -0,0 +1,15 @@
+"""CatalogColumns : agrégats de prix du catalogue, prix absents ou illisibles exclus."""
+
+
+def test_missing_prices_are_left_out_of_sums_and_means(app):
+    products = [{"id": 1, "prix": "100", "ville": "Niamey"}, {"id": 2, "prix": "", "ville": "Niamey"},
+                {"id": 3, "prix": "à débattre", "ville": "Zinder"}, {"id": 4, "prix": "300", "ville": "Zinder"},
+                {"id": 5, "prix": None, "ville": "Agadez"}]
+    catalog = app.CatalogColumns(products, version=1)
+
+    assert catalog.count == 5 and catalog.price_sum == 400
+    assert catalog.price_mean == 200.0
+    assert catalog.mean_price_by_city.to_dict() == {"Niamey": 100.0, "Zinder": 300.0}
+    assert catalog.stats_for_ids([1, 2])["avg_price"] == 100.0
+    assert catalog.stats_for_ids([2, 3]) == {"count": 2, "avg_price": None, "cities": 2}
+    assert app.CatalogColumns([], version=2).price_mean is None
@@ -0,0 +1,96 @@
+"""Flux data_versions / data_changes et fusion des deltas dans SharedTableCache."""
+import pytest
+
+
+@pytest.fixture
+def writer(app, store):
+    """Deuxième connexion sur la même base : les écritures d'un « autre processus »."""
+    return app.SQLiteStorage(store.path)
+
+
+@pytest.fixture
+def cache(app, store):
+    return app.SharedTableCache(store.fetch_table, ttl=60, feed=store)
+
+
+def catalog(cache):
+    return sorted((p["id"], p["produit"], p["prix"]) for p in cache.get("products"))
+
+
+def test_triggers_log_writes_and_tombstones(store):
+    rows = store.insert_products([{"produit": "Mangue", "prix": "100"}])
+    store.update_product(rows[0]["id"], {"prix": "120"})
+    store.delete_products([rows[0]["id"]])
+
+    changes = store.changes_since("products", 0)
+    assert [(c["row_id"], c["deleted"]) for c in changes] == [(1, 0), (1, 0), (1, 1)]
+    assert store.data_versions()["products"] == changes[-1]["seq"]
+
+
+def test_poll_merges_inserts_updates_and_deletes(cache, writer):
+    writer.insert_products([{"produit": "Mangue", "prix": "100"}, {"produit": "Riz", "prix": "50"}])
+    assert len(cache.get("products")) == 2
+    version = cache.version("products")
+
+    writer.insert_products([{"produit": "Mil", "prix": "30"}])
+    writer.update_product(1, {"prix": "120"})
+    writer.delete_products([2])
+    assert cache.poll(0, 24)
+
+    assert catalog(cache) == [(1, "Mangue", "120"), (3, "Mil", "30")]
+    assert cache.version("products") == version + 1        # un seul delta, pas de rechargement
+
+
+def test_replaced_row_reaches_listeners_as_delete_plus_insert(cache, writer):
+    writer.insert_products([{"produit": "Mangue", "prix": "100"}])
+    cache.get("products")
+    events = []
+    cache.on_change("products", lambda upserted, deleted, version: events.append(
+        ([p["id"] for p in upserted], sorted(deleted))))
+
+    writer.update_product(1, {"prix": "90"})
+    writer.insert_products([{"produit": "Mil"}])
+    cache.poll(0, 24)
+    assert events == [([1, 2], [1])]
+
+
+def test_local_writes_already_applied_are_not_reapplied(cache, store):
+    cache.get("products")
+    saved = store.insert_products([{"produit": "Sorgho"}])
+    cache.apply("products", upserted=saved)
+    version = cache.version("products")
+
+    assert cache.poll(0, 24)
+    assert cache.version("products") == version
+
+
+def test_insert_then_delete_between_polls_is_a_no_op(cache, writer):
+    cache.get("products")
+    version = cache.version("products")
+    row = writer.insert_products([{"produit": "Temp"}])[0]
+    writer.delete_products([row["id"]])
+
+    cache.poll(0, 24)
+    assert cache.version("products") == version and cache.get("products") == []
+
+
+def test_poll_is_throttled(cache, writer):
+    cache.get("products")
+    assert cache.poll(60, 24)
+    writer.insert_products([{"produit": "Mil"}])
+    assert not cache.poll(60, 24)
+    assert cache.get("products") == []
+
+
+def test_pruned_journal_forces_a_full_reload(cache, writer, store):
+    writer.insert_products([{"produit": "Mangue"}])
+    cache.get("products")
+    writer.insert_products([{"produit": "Mil"}])
+    with writer._tx() as conn:
+        conn.execute("update data_changes set changed_at = '2000-01-01 00:00:00'")
+    writer.prune_changes(1)
+    assert store.changes_since("products", 1) is None
+
+    cache.poll(0, 24)
+    assert not cache.loaded("products")                      # instantané invalidé
+    assert [p["produit"] for p in cache.get("products")] == ["Mangue", "Mil"]
@@ -0,0 +1,29 @@
+"""Agrégats sales_daily : maintenus à l'insertion, lus par période avec purchases_between."""
+import pytest
+
+
+def purchase(date_achat, prix, produit="Riz"):
+    return {"produit": produit, "prix": str(prix), "vendeur": "ali", "contact": "+22790000000",
+            "categorie": "alimentation", "ville": "Niamey", "date_achat": date_achat, "acheteur": "bob"}
+
+
+@pytest.fixture
+def sales(app, store, monkeypatch):
+    monkeypatch.setattr(app, "storage", store)
+    monkeypatch.setattr(app, "shared_cache", app.SharedTableCache(store.fetch_table, ttl=60, feed=store))
+    app.get_sales_rollup.clear()
+    return store
+
+
+def test_purchases_between_buckets_by_day_and_month(app, sales):
+    sales.insert_purchases([purchase("2024-01-31T23:00:00", 100), purchase("2024-02-02T08:00:00", 50),
+                            purchase("2024-02-02T09:30:00", 25, "Mil"), purchase("2023-12-01T00:00:00", 7)])
+
+    months = app.purchases_between("2024-01-15", "2024-03-01", "month")
+    assert months.index.tolist() == ["2024-01", "2024-02", "2024-03"]      # périodes complètes, vides comprises
+    assert months["units"].tolist() == [1, 2, 0]
+    assert months["revenue"].tolist() == [100.0, 75.0, 0.0]
+
+    days = app.purchases_between("2024-02-01", "2024-02-02")
+    assert days.to_dict("index") == {"2024-02-01": {"units": 0, "revenue": 0.0},
+                                     "2024-02-02": {"units": 2, "revenue": 75.0}}
@@ -0,0 +1,188 @@
+"""WriteBehindQueue : fusion, ordre d'envoi, drain ciblé, rejeu du journal après un arrêt brutal."""
+import json
+import os
+import time
+
+import pytest
+
+
+class RecordingStore:
+    """Enregistre les appels ; les utilisateurs de `failing` lèvent une erreur réseau."""
+
+    def __init__(self, failing=()):
+        self.calls   = []
+        self.failing = set(failing)
+
+    def upsert_cart_lines(self, rows):
+        self.calls.append(("upsert", [(r["username"], r["line_key"], r["quantity"]) for r in rows]))
+
+    def delete_cart_line(self, username, line_key):
+        self.calls.append(("delete_line", username, line_key))
+
+    def delete_cart(self, username):
+        if username in self.failing:
+            raise ConnectionError("base injoignable")
+        self.calls.append(("clear", username))
+
+    def update_product(self, product_id, fields):
+        self.calls.append(("update", product_id, fields))
+        if product_id in self.failing:
+            raise ConnectionError("base injoignable")
+
+    def delete_products(self, product_ids):
+        self.calls.append(("delete", list(product_ids)))
+
+
+def line(username, key, quantity=1):
+    return {"username": username, "line_key": key, "quantity": quantity}
+
+
+@pytest.fixture
+def make_queue(app, tmp_path):
+    def make(store, delay=3600.0, batch_size=50, journal="writes.jsonl"):
+        # délai long : rien ne part avant drain(), l'ordre des envois est déterministe
+        return app.WriteBehindQueue(store, str(tmp_path / journal), batch_size, delay)
+    return make
+
+
+def test_coalescing_keeps_last_write_and_merges_fields(make_queue):
+    store = RecordingStore()
+    queue = make_queue(store)
+    queue.enqueue("upsert_cart_line", line("bob", "a", 1))
+    queue.enqueue("upsert_cart_line", line("bob", "a", 2), line("bob", "b", 1))
+    queue.enqueue("update_product", {"id": 1, "fields": {"prix": "5"}})
+    queue.enqueue("update_product", {"id": 1, "fields": {"ville": "Zinder"}})
+    queue.enqueue("delete_product", {"id": 2})
+    queue.enqueue("update_product", {"id": 2, "fields": {"prix": "1"}})
+    assert queue.pending == 4 and store.calls == []
+
+    assert queue.drain(5)
+    assert store.calls == [
+        ("upsert", [("bob", "a", 2), ("bob", "b", 1)]),
+        ("update", 1, {"prix": "5", "ville": "Zinder"}),
+        ("delete", [2]),
+    ]
+
+
+def test_clear_cart_supersedes_earlier_lines_and_keeps_order(make_queue):
+    store = RecordingStore()
+    queue = make_queue(store)
+    queue.enqueue("upsert_cart_line", line("bob", "c"))
+    queue.enqueue("upsert_cart_line", line("ann", "c"))
+    queue.enqueue("delete_cart", {"username": "bob"})
+    queue.enqueue("upsert_cart_line", line("bob", "d"))
+
+    assert queue.drain(5)
+    assert store.calls == [("upsert", [("ann", "c", 1)]), ("clear", "bob"), ("upsert", [("bob", "d", 1)])]
+
+
+def test_scoped_drain_is_not_blocked_by_a_failing_write(make_queue):
+    store = RecordingStore(failing={"eve"})
+    queue = make_queue(store, delay=0.05)
+    queue.enqueue("delete_cart", {"username": "eve"})
+    queue.enqueue("upsert_cart_line", line("bob", "a"))
+
+    assert queue.drain(5, match=lambda key: key[:2] == ("cart", "bob"))
+    assert ("upsert", [("bob", "a", 1)]) in store.calls
+    assert queue.pending == 1 and "ConnectionError" in queue.last_error
+    assert not queue.drain(0.2, match=lambda key: key[:2] == ("cart", "eve"))
+
+
+def test_failed_command_waits_for_its_backoff_while_the_next_one_is_sent(make_queue):
+    store = RecordingStore(failing={1})
+    queue = make_queue(store)
+    queue.enqueue("update_product", {"id": 1, "fields": {"prix": "5"}})
+    queue.enqueue("update_product", {"id": 2, "fields": {"prix": "6"}})
+
+    started = time.monotonic()
+    assert not queue.drain(3, match=lambda key: key[0] == "product")
+    assert time.monotonic() - started < 1                  # tout ce qui reste est en backoff : pas d'attente
+    assert store.calls == [("update", 1, {"prix": "5"}), ("update", 2, {"prix": "6"})]
+    assert queue.pending == 1 and not os.path.exists(queue._path + ".failed")
+
+    queue.enqueue("update_product", {"id": 1, "fields": {"ville": "Agadez"}})
+    assert not queue.drain(1, match=lambda key: key[0] == "product")
+    assert [c for c in store.calls if c[1] == 1] == [("update", 1, {"prix": "5"})]
+
+
+def test_settle_writes_raises_at_once_when_writes_are_in_backoff(app, make_queue, monkeypatch):
+    queue = make_queue(RecordingStore(failing={1}))
+    monkeypatch.setattr(app, "write_queue", queue)
+    queue.enqueue("update_product", {"id": 1, "fields": {"prix": "5"}})
+
+    started = time.monotonic()
+    with pytest.raises(app.WritesPending):
+        app.settle_writes("products")
+    assert time.monotonic() - started < 1
+    app.settle_writes("carts")                             # aucune écriture de panier en attente
+    app.settle_writes("purchases")                         # table sans écriture différée
+
+
+def test_unacknowledged_commands_are_replayed_after_a_crash(make_queue, tmp_path):
+    crashed = make_queue(RecordingStore())
+    crashed.enqueue("upsert_cart_line", line("bob", "a", 3))
+    crashed.enqueue("update_product", {"id": 7, "fields": {"prix": "9"}})
+    journal = tmp_path / "writes.jsonl"
+    with open(journal, "a", encoding="utf-8") as f:
+        f.write('{"seq": 99, "op": "upsert_cart')      # dernière ligne tronquée par l'arrêt
+
+    store = RecordingStore()
+    queue = make_queue(store)                        # le rejeu part sans attendre le délai
+    assert queue.drain(5)
+    assert store.calls == [("upsert", [("bob", "a", 3)]), ("update", 7, {"prix": "9"})]
+    assert os.path.getsize(journal) == 0             # tout est acquitté : journal compacté
+
+    again = RecordingStore()
+    make_queue(again).drain(1)
+    assert again.calls == []
+
+
+def test_acknowledged_commands_are_not_replayed(make_queue, tmp_path):
+    store = RecordingStore(failing={"eve"})
+    queue = make_queue(store, delay=0.01)
+    queue.enqueue("delete_cart", {"username": "eve"})     # reste en échec : le journal n'est pas compacté
+    queue.enqueue("upsert_cart_line", line("bob", "a"))
+    assert queue.drain(5, match=lambda key: key[1] == "bob")
+
+    records = [json.loads(l) for l in open(tmp_path / "writes.jsonl", encoding="utf-8")]
+    assert any("ack" in r for r in records)
+    replayed = RecordingStore()
+    restarted = make_queue(replayed, journal="writes.jsonl")
+    assert restarted.drain(5)
+    assert replayed.calls == [("clear", "eve")]
+
+
+def test_each_process_claims_its_own_journal_and_adopts_orphans(app, make_queue, tmp_path):
+    base = str(tmp_path / "writes.jsonl")
+    first, first_lock   = app.claim_journal(base)
+    second, second_lock = app.claim_journal(base)                 # journal verrouillé : emplacement suivant
+    assert (first, second) == (base, base + ".1")
+
+    crashed = make_queue(RecordingStore(), journal="writes.jsonl.1")
+    crashed.enqueue("update_product", {"id": 3, "fields": {"prix": "8"}})
+    second_lock.close()                                           # arrêt du processus : verrou libéré
+
+    store = RecordingStore()
+    queue = make_queue(store)
+    for orphan, lock in app.orphan_journals(base, first):
+        with lock:
+            queue.adopt(orphan)
+    assert queue.drain(5)
+    assert store.calls == [("update", 3, {"prix": "8"})]
+    assert os.path.getsize(base + ".1") == 0
+    assert list(app.orphan_journals(base, first)) == []           # journal vidé : plus rien à reprendre
+    first_lock.close()
+
+
+def test_failing_command_goes_to_dead_letter_file(app, make_queue, tmp_path, monkeypatch):
+    monkeypatch.setattr(app.WriteBehindQueue, "MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(app.WriteBehindQueue, "MAX_BACKOFF", 0.02)
+    queue = make_queue(RecordingStore(failing={"zoe"}), delay=0.01)
+    queue.enqueue("delete_cart", {"username": "zoe"})
+
+    deadline = time.monotonic() + 5
+    while queue.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert queue.pending == 0
+    dead = [json.loads(l) for l in open(tmp_path / "writes.jsonl.failed", encoding="utf-8")]
+    assert dead == [{"op": "delete_cart", "args": {"username": "zoe"}, "error": "ConnectionError: base injoignable"}]